@@ -1,3 +1,7 @@
 from .agent_cmd import *
 from .agent_baselines import *
-from .agent_dqn import *
\ No newline at end of file
+from .agent_dqn import *
+from .state_encoder import *
+from .replay_buffer import *
+from .disk_replay import *
+from .learner import *
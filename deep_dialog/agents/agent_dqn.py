@@ -14,9 +14,7 @@ Command: python .\run.py --agt 9 --usr 1 --max_turn 40 --movie_kb_path .\deep_di
 '''
 
 
-import pandas as pd
-from joblib import load
-import random, copy, json
+import random, copy, json, threading
 import pickle as pickle
 import numpy as np
 import torch
@@ -27,6 +25,10 @@ from deep_dialog import dialog_config
 from .agent import Agent
 from deep_dialog.qlearning import DQN, DistributionalDQN
 from .prioritized_memory import *
+from .replay_buffer import ReplayBuffer
+from .disk_replay import DiskReplayBuffer
+from .state_encoder import StateEncoder
+from deep_dialog.topology import TopologyEmbedding, topology_registry
 
 
 class AgentDQN(Agent):
@@ -44,12 +46,14 @@ class AgentDQN(Agent):
         self.agent_run_mode = params['agent_run_mode']
         self.agent_act_level = params['agent_act_level']
         self.per = params['per']
-        if params['per']:
-            self.experience_replay_pool = Memory(params['experience_replay_pool_size'])
-        else:
-            self.experience_replay_pool = deque(
-                maxlen=params['experience_replay_pool_size'])
+        # PER: store new transitions with the max priority, their TD errors are computed in batches before training
+        self.per_max_priority = params.get('per_max_priority', 0)
+        # uniform replay memory-mapped in this directory (reopened when it exists)
+        self.replay_dir = params.get('replay_dir', None)
+        if self.per and self.replay_dir is not None:
+            raise Exception("prioritized replay cannot be kept on disk")
         
+        self.replay_lock = threading.RLock()  # the pool is shared with a learner thread
         self.experience_replay_pool_size = params.get('experience_replay_pool_size', 1000)
         self.hidden_size = params.get('dqn_hidden_size', 60)
         self.gamma = params.get('gamma', 0.9)
@@ -57,15 +61,63 @@ class AgentDQN(Agent):
         self.warm_start = params.get('warm_start', 0)
         
         self.max_turn = params['max_turn'] + 4
-        self.state_dimension = 2 * self.act_cardinality + 7 * self.slot_cardinality + 3 + self.max_turn +32
         
+        # Topology: k-means model and GRL embedding table, shared by all agents of the process
+        topology = params.get('topology') or topology_registry.get('movie')
+        self.contextual_dimension = 2 * self.act_cardinality + 7 * self.slot_cardinality + 3 + self.max_turn
+        topology.validate(self.contextual_dimension)
+        self.topology = TopologyEmbedding(topology, params.get('topology_cache_size', 50000))
+        self.state_dimension = self.contextual_dimension + self.topology.embedding_dim
+        
+        # Fine-tune the topology embeddings with the TD error: states then carry the cluster id instead of the embedding
+        self.finetune_topology = params.get('finetune_topology', 0)
+        self.state_encoder = StateEncoder(act_set, slot_set, self.max_turn,
+            1 if self.finetune_topology else self.topology.embedding_dim, params.get('sparse_state_width', 64))
+        
+        # Sparse states: replay keeps the dense values plus the indices of the active binary features,
+        # and the first layer of the Q-network is an embedding bag over those indices
+        self.sparse_state = params.get('sparse_state', 0)
+        if self.sparse_state:
+            # the network sees the topology embedding in place of the cluster id when fine-tuning
+            dense_size = self.state_encoder.dense_dimension - self.state_encoder.dimension + self.state_dimension
+            sparse_input = (dense_size, self.state_encoder.sparse_dimension)
+            network_input_size = dense_size + self.state_encoder.sparse_width
+            representation_size = self.state_encoder.packed_dimension
+            topology_column = self.state_encoder.dense_dimension - 1
+        else:
+            sparse_input = None
+            network_input_size = self.state_dimension
+            representation_size = self.state_encoder.dimension
+            topology_column = -1
+        self.representation_size = representation_size
+        self.reset_replay()
+
         if params['distributional']:
+            if self.finetune_topology:
+                raise Exception("topology fine-tuning is not implemented for the distributional DQN")
+            if self.sparse_state:
+                raise Exception("sparse states are not implemented for the distributional DQN")
+            if self.per_max_priority:
+                raise Exception("deferred PER priorities are not implemented for the distributional DQN")
             self.dqn = DistributionalDQN(self.state_dimension, self.hidden_size, self.num_actions, params['dueling_dqn'])
         else:
-            self.dqn = DQN(self.state_dimension, self.hidden_size, self.num_actions, params['dueling_dqn'],
-                params['double_dqn'], params['icm'], params['noisy'])
+            self.dqn = DQN(network_input_size, self.hidden_size, self.num_actions, params['dueling_dqn'],
+                params['double_dqn'], params['icm'], params['noisy'],
+                self.topology.embeddings if self.finetune_topology else None, params.get('topology_lr', 0.001),
+                sparse_input, topology_column)
         
         self.cur_bellman_err = 0
+        self.cluster_id = None
+        self.transition_logger = None  # TransitionLogger streaming every stored transition
+        
+        # Encoded states of the current turn: s_{t+1} registered on one turn is the s_t of the next one
+        self.encoded_states = deque(maxlen=2)
+        self.reuse_count = 0
+        
+        # Streaming k-means: move the centroids towards replayed states every kmeans_update_every training steps
+        self.kmeans_update_every = params.get('kmeans_update_every', 0)
+        self.kmeans_batch_size = params.get('kmeans_batch_size', 256)
+        self.train_steps = 0
                 
         # Prediction Mode: load trained DQN model
         if params['trained_model_path'] != None:
@@ -75,11 +127,26 @@ class AgentDQN(Agent):
             self.predict_mode = True
             self.warm_start = 2
 
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['replay_lock']  # locks cannot be copied, copies get their own
+        state['transition_logger'] = None  # copies do not log
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.replay_lock = threading.RLock()
+
     def reset_replay(self):    
         if self.per:
-            self.experience_replay_pool = Memory(self.experience_replay_pool_size)
+            self.experience_replay_pool = Memory(self.experience_replay_pool_size, self.representation_size)
+        elif self.replay_dir is not None:
+            if isinstance(getattr(self, 'experience_replay_pool', None), DiskReplayBuffer):
+                self.experience_replay_pool.clear()
+            else:  # resumes the buffer already in replay_dir
+                self.experience_replay_pool = DiskReplayBuffer(self.replay_dir, self.experience_replay_pool_size, self.representation_size)
         else:
-            self.experience_replay_pool = deque(maxlen=self.experience_replay_pool_size)
+            self.experience_replay_pool = ReplayBuffer(self.experience_replay_pool_size, self.representation_size)
             
     def initialize_episode(self):
         """ Initialize a new episode. This function is called every time a new episode is run. """
@@ -91,6 +158,7 @@ class AgentDQN(Agent):
         self.current_inform_slot_id = 0
 
         self.returns = [[], []]
+        self.encoded_states.clear()
         
         #self.request_set = dialog_config.movie_request_slots #['moviename', 'starttime', 'city', 'date', 'theater', 'numberofpeople']
         
@@ -105,134 +173,109 @@ class AgentDQN(Agent):
     def state_to_action(self, state):
         """ DQN: Input state, output action """
         
-        self.representation = self.prepare_state_representation(state)
+        self.representation = self.encode_state(state)[0]
         self.action = self.run_policy(self.representation)
-        act_slot_response = copy.deepcopy(self.feasible_actions[self.action])
+        return self.action_response(self.action)
+
+    def action_response(self, action):
+        """ Agent action (dialog act) of an action index """
+        
+        act_slot_response = copy.deepcopy(self.feasible_actions[action])
         return {'act_slot_response': act_slot_response, 'act_slot_value_response': None}
+
+    def new_episode_context(self):
+        """ Per-dialog progress of the rule policies, for agents acting in several dialogs at once """
+        return {'current_slot_id': 0, 'phase': 0, 'current_request_slot_id': 0, 'current_inform_slot_id': 0}
+
+    def states_to_actions(self, representations, contexts):
+        """ Epsilon-greedy actions (B,) of a (B, D) batch of state representations from B dialogs; greedy ones come from one forward pass """
+        
+        actions = np.zeros(len(contexts), dtype=np.int64)
+        greedy = []
+        for i, context in enumerate(contexts):
+            if random.random() < self.epsilon:
+                actions[i] = random.randint(0, self.num_actions - 1)
+            elif self.warm_start == 1:
+                if len(self.experience_replay_pool) > self.experience_replay_pool_size:
+                    self.warm_start = 2
+                # run the rule policy on this dialog's progress
+                for name in context:
+                    setattr(self, name, context[name])
+                actions[i] = self.rule_request_inform_policy()
+                for name in context:
+                    context[name] = getattr(self, name)
+            else:
+                greedy.append(i)
+        if len(greedy) > 0:
+            actions[greedy] = self.dqn.predict_batch(representations[greedy])
+        return actions
    
     def get_intrinsic_reward(self, s_t, s_t1, a):
         return self.dqn.get_intrinsic_reward(
-                self.prepare_state_representation(s_t),
-                self.prepare_state_representation(s_t1),
+                self.encode_state(s_t)[0],
+                self.encode_state(s_t1)[0],
                 np.array(self.action))
     
-    def prepare_state_representation(self, state):
-        """ Create the representation for each state """
+    def prepare_state_representation(self, state, out=None):
+        """ Create the representation for each state, written into out (a row of a batch matrix) or into the encoder buffer """
         
-        user_action = state['user_action']
-        current_slots = state['current_slots']
-        kb_results_dict = state['kb_results_dict']
-        agent_last = state['agent_action']
+        representation = self.state_encoder.encode(state, None if self.sparse_state else out)
         
         ########################################################################
-        #   Create one-hot of acts to represent the current user action
-        ########################################################################
-        user_act_rep =  np.zeros((1, self.act_cardinality))
-        user_act_rep[0,self.act_set[user_action['diaact']]] = 1.0
-
-        ########################################################################
-        #     Create bag of inform slots representation to represent the current user action
+        #   Representation of Topological information
         ########################################################################
-        user_inform_slots_rep = np.zeros((1, self.slot_cardinality))
-        for slot in list(user_action['inform_slots'].keys()):
-            user_inform_slots_rep[0,self.slot_set[slot]] = 1.0
+        self.cluster_id, Topol_rep = self.topology.lookup_cluster(representation[:, :self.contextual_dimension])
 
-        ########################################################################
-        #   Create bag of request slots representation to represent the current user action
-        ########################################################################
-        user_request_slots_rep = np.zeros((1, self.slot_cardinality))
-        for slot in list(user_action['request_slots'].keys()):
-            user_request_slots_rep[0, self.slot_set[slot]] = 1.0
+        if self.finetune_topology:
+            representation[0, self.contextual_dimension] = self.cluster_id
+        else:
+            representation[0, self.contextual_dimension:] = Topol_rep
+        if self.sparse_state:
+            return self.state_encoder.pack(representation, None if out is None else out.reshape(1, -1))
+        return representation
 
-        ########################################################################
-        #   Creat bag of filled_in slots based on the current_slots
-        ########################################################################
-        current_slots_rep = np.zeros((1, self.slot_cardinality))
-        for slot in current_slots['inform_slots']:
-            current_slots_rep[0, self.slot_set[slot]] = 1.0
 
-        ########################################################################
-        #   Encode last agent act
-        ########################################################################
-        agent_act_rep = np.zeros((1,self.act_cardinality))
-        if agent_last:
-            agent_act_rep[0, self.act_set[agent_last['diaact']]] = 1.0
+    def prepare_state_representation_batch(self, states, out=None):
+        """ Representations (B, D) float32 and cluster ids (B,) of the states of many dialogs, clustered and embedded in one call """
+        
+        representations = self.state_encoder.encode_batch(states, None if self.sparse_state else out)
+        cluster_ids, Topol_reps = self.topology.lookup_batch(representations[:, :self.contextual_dimension])
+        
+        if self.finetune_topology:
+            representations[:, self.contextual_dimension] = cluster_ids
+        else:
+            representations[:, self.contextual_dimension:] = Topol_reps
+        if self.sparse_state:
+            representations = self.state_encoder.pack(representations, out)
+        return representations, cluster_ids
 
-        ########################################################################
-        #   Encode last agent inform slots
-        ########################################################################
-        agent_inform_slots_rep = np.zeros((1, self.slot_cardinality))
-        if agent_last:
-            for slot in list(agent_last['inform_slots'].keys()):
-                agent_inform_slots_rep[0,self.slot_set[slot]] = 1.0
+    def encode_state(self, state):
+        """ Representation (in its own row) and cluster id of a state, encoded once per turn
 
-        ########################################################################
-        #   Encode last agent request slots
-        ########################################################################
-        agent_request_slots_rep = np.zeros((1, self.slot_cardinality))
-        if agent_last:
-            for slot in list(agent_last['request_slots'].keys()):
-                agent_request_slots_rep[0,self.slot_set[slot]] = 1.0
+        A state seen again on the same turn (s_t when registering the transition, s_{t+1} when it
+        becomes the next s_t) is served from encoded_states and counted in reuse_count.
+        """
         
-        turn_rep = np.zeros((1,1)) + state['turn'] / 10.
+        for encoded_state, turn, representation, cluster_id in self.encoded_states:
+            if encoded_state is state and turn == state['turn']:
+                self.reuse_count += 1
+                return representation, cluster_id
+        
+        representation = self.prepare_state_representation(state, np.empty(self.representation_size, dtype=np.float32))
+        self.encoded_states.append((state, state['turn'], representation, self.cluster_id))
+        return representation, self.cluster_id
 
-        ########################################################################
-        #  One-hot representation of the turn count?
-        ########################################################################
-        turn_onehot_rep = np.zeros((1, self.max_turn))
-        turn_onehot_rep[0, state['turn']] = 1.0
+    def encoding_stats(self):
+        """ Number of state encodings and of encodings saved by reusing the previous turn """
+        return {'encoded': self.state_encoder.encode_count, 'reused': self.reuse_count}
 
-        ########################################################################
-        #   Representation of KB results (scaled counts)
-        ########################################################################
-        kb_count_rep = np.zeros((1, self.slot_cardinality + 1)) + kb_results_dict['matching_all_constraints'] / 100.
-        for slot in kb_results_dict:
-            if slot in self.slot_set:
-                kb_count_rep[0, self.slot_set[slot]] = kb_results_dict[slot] / 100.
+    def state_cluster(self, state):
+        """ Cluster id of a state (free for the states of the current turn) """
+        return self.encode_state(state)[1]
 
-        ########################################################################
-        #   Representation of KB results (binary)
-        ########################################################################
-        kb_binary_rep = np.zeros((1, self.slot_cardinality + 1)) + np.sum( kb_results_dict['matching_all_constraints'] > 0.)
-        for slot in kb_results_dict:
-            if slot in self.slot_set:
-                kb_binary_rep[0, self.slot_set[slot]] = np.sum( kb_results_dict[slot] > 0.)
-
-        ########################################################################
-        #   Representation of Topological information
-        ########################################################################
-        contextual_rep = np.hstack([user_act_rep, user_inform_slots_rep, user_request_slots_rep, agent_act_rep, agent_inform_slots_rep, agent_request_slots_rep, current_slots_rep, turn_rep, turn_onehot_rep, kb_binary_rep, kb_count_rep])
-        Topol_rep = self.get_graph_embedding(
-                    contextual_rep=contextual_rep,
-                    kmeans_path='/content/drive/MyDrive/DialogDQN-Variants/kmeans_modelMovie_k40.joblib',
-                    grl_csv_path='/content/drive/MyDrive/DialogDQN-Variants/movie40graphsage-n32_node_embeddings_adj_recon.pt'
-                    )
-
-        self.final_representation = np.hstack([user_act_rep, user_inform_slots_rep, user_request_slots_rep, agent_act_rep, agent_inform_slots_rep, agent_request_slots_rep, current_slots_rep, turn_rep, turn_onehot_rep, kb_binary_rep, kb_count_rep, [Topol_rep]])
-        return self.final_representation
-
-
-    def get_graph_embedding(sekf, contextual_rep, kmeans_path, grl_csv_path):
-        # 1. Load saved KMeans model
-        kmeans = load(kmeans_path)
-
-        # 2. Predict cluster index
-        cluster_idx = kmeans.predict(contextual_rep.reshape(1, -1))[0]
-
-        # 3. Load graph embeddings
-        if grl_csv_path.endswith('.csv'):       
-            embeddings_df = pd.read_csv(grl_csv_path)            
-            # Rename the first unnamed column to 'id' and ensure it's integer
-            embeddings_df.rename(columns={embeddings_df.columns[0]: 'id'}, inplace=True)
-            embeddings_df['id'] = embeddings_df['id'].astype(int)
-            # Find the embedding vector for the given cluster index
-            node_embedding = embeddings_df[embeddings_df['id'] == cluster_idx].iloc[:, 1:].values.squeeze()
-        else:
-            embeddings_tensor = torch.load(grl_csv_path)  # .pt or .pth
-            embeddings_np = embeddings_tensor.detach().cpu().numpy()
-            node_embedding = embeddings_np[cluster_idx]
-            
-        return node_embedding
+    def get_graph_embedding(self, contextual_rep):
+        """ Topology embedding of the cluster the contextual representation falls in (no file access) """
+        return self.topology.lookup(contextual_rep)
 
     def run_policy(self, representation):
         """ epsilon-greedy policy """
@@ -313,44 +356,85 @@ class AgentDQN(Agent):
     
     def register_experience_replay_tuple(self, s_t, a_t, reward, s_tplus1, episode_over):
         """ Register feedback from the environment, to be stored as future training data """
-        state_t_rep = self.prepare_state_representation(s_t)
-        action_t = self.action
-        reward_t = reward
-        state_tplus1_rep = self.prepare_state_representation(s_tplus1)
+        state_t_rep = self.encode_state(s_t)[0]
+        state_tplus1_rep = self.encode_state(s_tplus1)[0]
+        self.append_experience(state_t_rep, self.action, reward, state_tplus1_rep, episode_over)
+
+    def append_experience(self, state_t_rep, action_t, reward_t, state_tplus1_rep, episode_over):
+        """ Store an encoded transition (s_t, a_t, r, s_{t+1}, episode_over) in the experience replay pool """
+        
         training_example = (state_t_rep, action_t, reward_t, state_tplus1_rep, episode_over)
-        if isinstance(self.experience_replay_pool, Memory):
-            target = self.dqn.model(self.dqn.Variable(torch.FloatTensor(state_tplus1_rep))).data
+        if isinstance(self.experience_replay_pool, Memory) and self.per_max_priority:
+            training_example = (None, training_example)  # TD error computed later by refresh_priorities
+        elif isinstance(self.experience_replay_pool, Memory):
+            state_tplus1 = self.dqn.featurize(self.dqn.Variable(torch.FloatTensor(state_tplus1_rep)))
+            target = self.dqn.model(state_tplus1).data
             old_val = target[0][action_t].data
-            target_q = self.dqn.target_model(self.dqn.Variable(torch.FloatTensor(state_tplus1_rep)))
+            target_q = self.dqn.target_model(state_tplus1)
             target[0][action_t] = reward_t + self.gamma * (1 - episode_over) * target_q.max()
             err = torch.abs(old_val - target[0][action_t]).item()
             training_example = (err, training_example)
         
-        if self.predict_mode == False: # Training Mode
-            if self.warm_start == 1:
+        with self.replay_lock:
+            if self.predict_mode == False: # Training Mode
+                if self.warm_start == 1:
+                    self.experience_replay_pool.append(training_example)
+                    self.log_transition(training_example)
+            else: # Prediction Mode
                 self.experience_replay_pool.append(training_example)
-        else: # Prediction Mode
-            self.experience_replay_pool.append(training_example)
+                self.log_transition(training_example)
+
+    def log_transition(self, training_example):
+        if self.transition_logger is not None:
+            self.transition_logger.append(training_example[1] if isinstance(self.experience_replay_pool, Memory) else training_example)
     
     def train(self, batch_size=1, num_batches=100):
         """ Train DQN with experience replay """
         
+        self.cur_bellman_err = 0
+        intrinsic_reward = 0
+        if self.per_max_priority and isinstance(self.experience_replay_pool, Memory):
+            self.refresh_priorities()
         for iter_batch in range(num_batches):
-            self.cur_bellman_err = 0
-            intrinsic_reward = 0
-            if isinstance(self.experience_replay_pool, Memory):
-                batch, idx, _ = self.experience_replay_pool.sample(batch_size)
-            else:
-                batch = [random.choice(self.experience_replay_pool) for i in range(batch_size)]
+            with self.replay_lock:
+                pool = self.experience_replay_pool
+                if isinstance(pool, Memory):
+                    batch, idx, _ = pool.sample(batch_size)
+                else:
+                    batch = pool.sample(batch_size)
             batch_struct = self.dqn.singleBatch(batch, {'gamma': self.gamma})
             self.cur_bellman_err += batch_struct['cost']['total_cost']
             intrinsic_reward += batch_struct['intrinsic_reward']
-            if isinstance(self.experience_replay_pool, Memory):
-                err = batch_struct['error']
-                for i in range(batch_size):
-                    self.experience_replay_pool.update(idx[i], err[i])
-            return self.cur_bellman_err, intrinsic_reward
-            print(("cur bellman err %.4f, experience replay pool %s" % (float(self.cur_bellman_err)/len(self.experience_replay_pool), len(self.experience_replay_pool))))
+            if isinstance(pool, Memory):
+                with self.replay_lock:
+                    pool.update(idx, batch_struct['error'])
+            self.train_steps += 1
+            if self.kmeans_update_every > 0 and self.train_steps % self.kmeans_update_every == 0:
+                self.update_clusters(self.kmeans_batch_size)
+        return self.cur_bellman_err, intrinsic_reward
+            
+    def refresh_priorities(self, batch_size=256):
+        """ Replace the max priority of newly stored transitions with their TD error, batch_size transitions per forward pass """
+        
+        pool = self.experience_replay_pool
+        while True:
+            with self.replay_lock:
+                idx = pool.pop_pending(batch_size)
+                if len(idx) == 0:
+                    return
+                batch = pool.buffer.gather(idx)
+            err = self.dqn.td_error(batch, self.gamma)
+            with self.replay_lock:
+                pool.update(idx, err)
+            
+    def update_clusters(self, batch_size):
+        """ Streaming k-means step on contextual states sampled from the replay pool """
+        
+        with self.replay_lock:
+            states = self.experience_replay_pool.sample_states(batch_size)
+        if self.sparse_state:
+            states = self.state_encoder.unpack(states)
+        self.topology.update_clusters(states[:, :self.contextual_dimension])
             
     ################################################################################
     #    Debug Functions
@@ -368,7 +452,13 @@ class AgentDQN(Agent):
     def load_experience_replay_from_file(self, path):
         """ Load the experience replay pool from a file"""
         
-        self.experience_replay_pool = pickle.load(open(path, 'rb'))
+        pool = pickle.load(open(path, 'rb'))
+        if not isinstance(pool, (Memory, ReplayBuffer)):
+            # pools saved as a deque of tuples
+            examples, pool = pool, ReplayBuffer(self.experience_replay_pool_size, self.representation_size)
+            for example in examples:
+                pool.append(example)
+        self.experience_replay_pool = pool
     
              
     def load_trained_DQN(self, path):
@@ -0,0 +1,188 @@
+"""
+Memory-mapped experience replay
+
+A DiskReplayBuffer keeps its columns as .npy files in a directory, memory-mapped so
+the buffer can be larger than RAM:
+
+    states.npy            (2 * capacity, D) float32, ring of encoded states
+    state_index.npy       (capacity, 1) int64, row of s_t in states
+    next_state_index.npy  (capacity, 1) int64, row of s_{t+1} in states
+    actions.npy, rewards.npy, dones.npy   (capacity, 1)
+    meta.json             write positions and number of stored transitions
+
+s_t of a transition is usually the s_{t+1} of the previous one and is stored once.
+Every transition adds at most two states, so the states of the last capacity
+transitions are never overwritten. meta.json is replaced atomically after the
+columns are flushed (every flush_every transitions and on flush()). Before the
+first append after a flush, meta.json records that up to flush_every transitions
+may be written past the flushed positions (dirty_rows). Opening a dirty buffer,
+after a crash or while its writer is appending, discards the oldest transitions
+those appends may have overwritten: the rows after the write position and the rows
+whose states lie in the next 2 * dirty_rows state slots. Other processes can open
+the same directory with readonly=True and call refresh() to see newly flushed rows.
+"""
+
+import os, json
+import numpy as np
+import torch
+
+from .replay_buffer import ReplayBuffer
+
+
+class DiskReplayBuffer(ReplayBuffer):
+    """ ReplayBuffer whose columns are memory-mapped files in a directory; reopens the buffer found there """
+
+    columns = ('state_index', 'next_state_index', 'actions', 'rewards', 'dones')
+
+    def __init__(self, path, capacity=None, state_dimension=None, readonly=False, flush_every=1000):
+        self.path = path
+        self.readonly = readonly
+        self.flush_every = flush_every
+        self.unflushed = 0
+        self.states = None
+
+        meta = self.read_meta()
+        if meta is not None:
+            if (capacity is not None and capacity != meta['capacity']) or (state_dimension is not None and state_dimension != meta['state_dimension']):
+                raise Exception("replay buffer in %s has capacity %s and state dimension %s" % (path, meta['capacity'], meta['state_dimension']))
+            self.capacity = meta['capacity']
+            self.open(meta['state_dimension'])
+            self.load_meta(meta)
+        elif readonly:
+            raise Exception("no replay buffer in %s" % (path, ))
+        else:
+            if capacity is None:
+                raise Exception("the capacity of a new replay buffer is required")
+            self.capacity = capacity
+            self.write = 0
+            self.n_entries = 0
+            self.state_write = 0
+            self.last_next_state = -1
+            self.dirty_rows = 0
+            if state_dimension is not None:
+                self.allocate(state_dimension)
+
+    def read_meta(self):
+        meta_path = os.path.join(self.path, 'meta.json')
+        if not os.path.exists(meta_path):
+            return None
+        with open(meta_path) as f:
+            return json.load(f)
+
+    def load_meta(self, meta):
+        self.__dict__.update(meta)
+        self.dirty_rows = meta.get('dirty_rows', 0)
+        if self.dirty_rows > 0 and self.n_entries > 0:
+            rows = self.rows()
+            unsafe = lambda index: (index[:, 0] - self.state_write) % len(self.states) < 2 * self.dirty_rows
+            overwritten = ((rows - self.write) % self.capacity < self.dirty_rows) | unsafe(self.state_index[rows]) | unsafe(self.next_state_index[rows])
+            if overwritten.any():
+                # rows are oldest first: keep the transitions after the last one that may be overwritten
+                self.n_entries -= int(np.flatnonzero(overwritten)[-1]) + 1
+
+    def allocate(self, state_dimension):
+        """ Create the column files of a new buffer """
+
+        os.makedirs(self.path, exist_ok=True)
+        self.state_dimension = state_dimension
+        create = lambda name, shape, dtype: np.lib.format.open_memmap(os.path.join(self.path, name + '.npy'), mode='w+', dtype=dtype, shape=shape)
+        self.states = create('states', (2 * self.capacity, state_dimension), np.float32)
+        self.state_index = create('state_index', (self.capacity, 1), np.int64)
+        self.next_state_index = create('next_state_index', (self.capacity, 1), np.int64)
+        self.actions = create('actions', (self.capacity, 1), np.int64)
+        self.rewards = create('rewards', (self.capacity, 1), np.float32)
+        self.dones = create('dones', (self.capacity, 1), np.float32)
+        self.flush()
+
+    def open(self, state_dimension):
+        self.state_dimension = state_dimension
+        mode = 'r' if self.readonly else 'r+'
+        for name in ('states', ) + self.columns:
+            setattr(self, name, np.load(os.path.join(self.path, name + '.npy'), mmap_mode=mode))
+
+    def append(self, example):
+        if self.readonly:
+            raise Exception("replay buffer in %s is read-only" % (self.path, ))
+        state, action, reward, next_state, done = example
+        if self.states is None:
+            self.allocate(np.size(state))
+        if self.unflushed == 0:
+            self.write_meta(self.flush_every)  # before any slot past the flushed positions is reused
+        state = np.ravel(state)
+        if self.last_next_state >= 0 and np.array_equal(self.states[self.last_next_state], state):
+            state_index = self.last_next_state
+        else:
+            state_index = self.append_state(state)
+        self.last_next_state = self.append_state(np.ravel(next_state))
+
+        i = self.write
+        self.state_index[i] = state_index
+        self.next_state_index[i] = self.last_next_state
+        self.actions[i] = action
+        self.rewards[i] = reward
+        self.dones[i] = done
+
+        self.write = (self.write + 1) % self.capacity
+        self.n_entries = min(self.n_entries + 1, self.capacity)
+        self.unflushed += 1
+        if self.unflushed >= self.flush_every:
+            self.flush()
+
+    def append_state(self, state):
+        i = self.state_write
+        self.states[i] = state
+        self.state_write = (self.state_write + 1) % len(self.states)
+        return i
+
+    def clear(self):
+        self.write = 0
+        self.n_entries = 0
+        self.last_next_state = -1
+        self.flush()
+
+    def flush(self):
+        """ Write the columns to disk, then the positions that make them visible """
+
+        if self.readonly or self.states is None:
+            return
+        for name in ('states', ) + self.columns:
+            getattr(self, name).flush()
+        self.write_meta(0)
+        self.unflushed = 0
+
+    def write_meta(self, dirty_rows):
+        """ Positions of the flushed transitions, and how many transitions may be written after them """
+
+        self.dirty_rows = dirty_rows
+        meta = {'capacity': self.capacity, 'state_dimension': int(self.state_dimension), 'write': self.write, 'n_entries': self.n_entries,
+                'state_write': self.state_write, 'last_next_state': int(self.last_next_state), 'dirty_rows': dirty_rows}
+        meta_path = os.path.join(self.path, 'meta.json')
+        with open(meta_path + '.tmp', 'w') as f:
+            json.dump(meta, f)
+        os.replace(meta_path + '.tmp', meta_path)
+
+    def refresh(self):
+        """ Read-only buffers: see the transitions flushed by the writer since opening """
+
+        self.load_meta(self.read_meta())
+
+    def close(self):
+        self.flush()
+
+    def gather(self, idx):
+        return (torch.from_numpy(self.states[self.state_index[idx, 0]]), torch.from_numpy(self.actions[idx]), torch.from_numpy(self.rewards[idx]),
+                torch.from_numpy(self.states[self.next_state_index[idx, 0]]), torch.from_numpy(self.dones[idx]))
+
+    def sample_states(self, n):
+        return self.states[self.state_index[self.sample_indices(n), 0]]
+
+    def __getitem__(self, index):
+        i = self.position(index)
+        state, next_state = self.state_index[i, 0], self.next_state_index[i, 0]
+        return (np.array(self.states[state:state+1]), int(self.actions[i, 0]), float(self.rewards[i, 0]),
+                np.array(self.states[next_state:next_state+1]), bool(self.dones[i, 0]))
+
+    def __reduce__(self):
+        # copies and pickles reopen the files read-only, only one writer per directory
+        self.flush()
+        return (DiskReplayBuffer, (self.path, None, None, True, self.flush_every))
@@ -0,0 +1,79 @@
+"""
+Decoupled learner
+
+A background thread performs the gradient updates of an agent on its experience
+replay pool while the dialogs keep running. The actors only report how many
+transitions they stored (observe); the learner keeps the number of updates at
+replay_ratio updates per environment transition, and waits when it is ahead.
+Actors read the Q-network while it is being updated (Hogwild style); replay
+access is guarded by the agent's replay_lock.
+"""
+
+import threading, time
+
+
+class LearnerThread(threading.Thread):
+    """ Train an agent in the background at replay_ratio gradient updates per environment transition """
+
+    def __init__(self, agent, batch_size=16, replay_ratio=1.0):
+        threading.Thread.__init__(self, daemon=True)
+        self.agent = agent
+        self.batch_size = batch_size
+        self.replay_ratio = replay_ratio
+        self.condition = threading.Condition()
+        self.running = True
+
+        self.env_steps = 0
+        self.update_count = 0
+        self.train_time = 0.
+        self.start_time = time.time()
+        self.window = {'updates': 0, 'loss': 0., 'intrinsic_reward': 0., 'start': self.start_time}
+
+    def observe(self, n_transitions=1):
+        """ Credit n_transitions new transitions in the replay pool; never waits for training """
+
+        with self.condition:
+            self.env_steps += n_transitions
+            self.condition.notify()
+
+    def set_replay_ratio(self, replay_ratio):
+        with self.condition:
+            self.replay_ratio = replay_ratio
+            self.condition.notify()
+
+    def run(self):
+        while True:
+            with self.condition:
+                while self.running and (self.update_count >= self.env_steps * self.replay_ratio or len(self.agent.experience_replay_pool) == 0):
+                    self.condition.wait(0.1)
+                if not self.running:
+                    return
+
+            start = time.time()
+            err, i_r = self.agent.train(self.batch_size, 1)
+            self.train_time += time.time() - start
+            with self.condition:
+                self.update_count += 1
+                self.window['updates'] += 1
+                self.window['loss'] += err
+                self.window['intrinsic_reward'] += i_r
+
+    def stop(self):
+        """ Stop after the current update """
+
+        with self.condition:
+            self.running = False
+            self.condition.notify()
+        self.join()
+
+    def stats(self):
+        """ Throughput counters; loss and intrinsic reward are sums over the updates since the previous call """
+
+        with self.condition:
+            now = time.time()
+            window, self.window = self.window, {'updates': 0, 'loss': 0., 'intrinsic_reward': 0., 'start': now}
+            return {'env_steps': self.env_steps, 'updates': self.update_count,
+                    'replay_ratio': float(self.update_count) / max(self.env_steps, 1),
+                    'updates_per_sec': window['updates'] / max(now - window['start'], 1e-10),
+                    'train_time': self.train_time,
+                    'window_updates': window['updates'], 'loss': window['loss'], 'intrinsic_reward': window['intrinsic_reward']}
@@ -1,52 +1,92 @@
-import random
 import numpy as np
 from .sum_tree import SumTree
+from .replay_buffer import ReplayBuffer
 
-class Memory:  # stored as ( s, a, r, s_ ) in SumTree
+class Memory:  # transitions in a ReplayBuffer, their priorities in a SumTree
     e = 1e-10
     a = 0.1
     beta = 0.0
     beta_increment_per_sampling = 0.000
 
-    def __init__(self, capacity):
+    def __init__(self, capacity, state_dimension=None):
         self.tree = SumTree(capacity)
+        self.buffer = ReplayBuffer(capacity, state_dimension)
         self.capacity = capacity
+        self.max_priority = 1.0
+        self.pending = []  # slots stored with max_priority, waiting for their TD error
 
     def _get_priority(self, error):
-        return (error + self.e) ** self.a
+        return (np.ravel(error) + self.e) ** self.a
 
     def append(self, data):
+        """ Store (error, sample); an error of None stores the sample with the largest priority seen so far """
+
         error, sample = data
-        p = self._get_priority(error)
-        self.tree.add(p, sample)
+        idx = self.buffer.write
+        self.buffer.append(sample)
+        if error is None:
+            p = self.max_priority
+            self.pending.append(idx)
+        else:
+            p = self._get_priority(error)
+            self.max_priority = max(self.max_priority, p.max())
+        self.tree.update(idx, p)
+
+    def pop_pending(self, n=None):
+        """ Up to n (all when None) distinct slots stored without an error """
+
+        n = len(self.pending) if n is None else n
+        idx, self.pending = self.pending[:n], self.pending[n:]
+        return np.unique(np.asarray(idx, dtype=np.int64))
+
+    def sample_indices(self, n):
+        """ Stratified sampling: one slot per equal segment of the total priority """
+
+        if len(self) == 0:
+            raise Exception("cannot sample from an empty replay memory")
+        s = (np.arange(n) + np.random.uniform(size=n)) * (self.tree.total() / n)
+        return np.minimum(self.tree.find(s), len(self) - 1)
 
     def sample(self, n):
-        batch = []
-        idxs = []
-        segment = self.tree.total() / n
-        priorities = []
+        """ n transitions as tensors (see ReplayBuffer.sample), their slots and importance sampling weights """
 
+        idxs = self.sample_indices(n)
         self.beta = np.min([1., self.beta + self.beta_increment_per_sampling])
 
-        for i in range(n):
-            a = segment * i
-            b = segment * (i + 1)
+        # the largest weight belongs to the smallest priority
+        is_weight = np.power(self.tree.priorities(idxs) / self.tree.min(), -self.beta)
 
-            s = random.uniform(a, b)
-            (idx, p, data) = self.tree.get(s)
-            priorities.append(p)
-            batch.append(data)
-            idxs.append(idx)
+        return self.buffer.gather(idxs), idxs, is_weight
 
-        sampling_probabilities = priorities / (self.tree.total() + 1e-10)
-        is_weight = np.power(self.tree.n_entries * sampling_probabilities, -self.beta)
-        is_weight /= is_weight.max() + 1e-10
-
-        return batch, idxs, is_weight
+    def sample_states(self, n):
+        return self.buffer.states[self.sample_indices(n)]
 
     def update(self, idx, error):
+        """ Set the priorities of the slots idx (scalar or vector) from their errors """
+
         p = self._get_priority(error)
+        self.max_priority = max(self.max_priority, p.max())
         self.tree.update(idx, p)
 
     def __len__(self):
-        return self.tree.n_entries
+        return len(self.buffer)
+
+    def __getitem__(self, index):
+        return self.buffer[index]
+
+    def __iter__(self):
+        return iter(self.buffer)
+
+    def __getstate__(self):
+        # the buffer pickles its rows oldest first: keep the priorities in the same order
+        state = self.__dict__.copy()
+        del state['tree']
+        state['priorities'] = self.tree.priorities(self.buffer.rows())
+        state['pending'] = list((np.asarray(self.pending, dtype=np.int64) - self.buffer.write + len(self.buffer)) % self.capacity)
+        return state
+
+    def __setstate__(self, state):
+        priorities = state.pop('priorities')
+        self.__dict__.update(state)
+        self.tree = SumTree(self.capacity)
+        self.tree.update(np.arange(len(priorities)), priorities)
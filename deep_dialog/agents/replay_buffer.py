@@ -0,0 +1,119 @@
+"""
+Array-backed experience replay
+
+Transitions are written into preallocated columns (states, actions, rewards, next
+states, done flags) at a circular write index, so a full buffer overwrites its
+oldest transition like a bounded deque. Sampling draws a vector of indices and
+gathers the columns straight into torch tensors, instead of picking Python tuples
+one by one and stacking them again on every training step.
+"""
+
+import numpy as np
+import torch
+
+
+class ReplayBuffer:
+    """ Uniform experience replay of (s_t, a_t, r, s_{t+1}, episode_over) in fixed-size arrays """
+
+    def __init__(self, capacity, state_dimension=None):
+        self.capacity = capacity
+        self.write = 0
+        self.n_entries = 0
+        self.states = None
+        if state_dimension is not None:
+            self.allocate(state_dimension)
+
+    def allocate(self, state_dimension):
+        """ Allocate the columns; the state width is taken from the first transition when not given """
+
+        self.state_dimension = state_dimension
+        self.states = np.zeros((self.capacity, state_dimension), dtype=np.float32)
+        self.next_states = np.zeros((self.capacity, state_dimension), dtype=np.float32)
+        self.actions = np.zeros((self.capacity, 1), dtype=np.int64)
+        self.rewards = np.zeros((self.capacity, 1), dtype=np.float32)
+        self.dones = np.zeros((self.capacity, 1), dtype=np.float32)
+
+    def append(self, example):
+        state, action, reward, next_state, done = example
+        if self.states is None:
+            self.allocate(np.size(state))
+        i = self.write
+        self.states[i] = np.ravel(state)
+        self.actions[i] = action
+        self.rewards[i] = reward
+        self.next_states[i] = np.ravel(next_state)
+        self.dones[i] = done
+
+        self.write = (self.write + 1) % self.capacity
+        self.n_entries = min(self.n_entries + 1, self.capacity)
+
+    def clear(self):
+        self.write = 0
+        self.n_entries = 0
+
+    def sample_indices(self, n):
+        """ n uniform draws (with replacement) among the stored transitions """
+
+        if self.n_entries == 0:
+            raise Exception("cannot sample from an empty replay buffer")
+        return np.random.randint(0, self.n_entries, n)
+
+    def sample(self, n):
+        """ n uniform transitions as tensors: states (n, D), actions (n, 1) long, rewards (n, 1), next states (n, D), dones (n, 1) """
+
+        return self.gather(self.sample_indices(n))
+
+    def gather(self, idx):
+        return (torch.from_numpy(self.states[idx]), torch.from_numpy(self.actions[idx]), torch.from_numpy(self.rewards[idx]),
+                torch.from_numpy(self.next_states[idx]), torch.from_numpy(self.dones[idx]))
+
+    def sample_states(self, n):
+        """ States only, as a (n, D) array """
+
+        return self.states[self.sample_indices(n)]
+
+    def position(self, index):
+        """ Row of the index-th oldest transition """
+
+        if index < 0:
+            index += self.n_entries
+        if index < 0 or index >= self.n_entries:
+            raise IndexError("replay buffer index out of range")
+        return (self.write - self.n_entries + index) % self.capacity
+
+    def rows(self):
+        """ Rows of all stored transitions, oldest first """
+
+        return (self.write - self.n_entries + np.arange(self.n_entries)) % self.capacity
+
+    def __len__(self):
+        return self.n_entries
+
+    def __getitem__(self, index):
+        """ The index-th oldest transition as a (s_t, a_t, r, s_{t+1}, episode_over) tuple """
+
+        i = self.position(index)
+        return (self.states[i:i+1], int(self.actions[i, 0]), float(self.rewards[i, 0]), self.next_states[i:i+1], bool(self.dones[i, 0]))
+
+    def __iter__(self):
+        for index in range(self.n_entries):
+            yield self[index]
+
+    def __getstate__(self):
+        # only the stored rows are pickled
+        state = self.__dict__.copy()
+        if self.states is not None:
+            rows = self.rows()
+            for name in ('states', 'next_states', 'actions', 'rewards', 'dones'):
+                state[name] = getattr(self, name)[rows]
+            state['write'] = self.n_entries % self.capacity
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        if self.states is not None and len(self.states) < self.capacity:
+            n_entries = len(self.states)
+            columns = [(name, getattr(self, name)) for name in ('states', 'next_states', 'actions', 'rewards', 'dones')]
+            self.allocate(self.state_dimension)
+            for name, column in columns:
+                getattr(self, name)[:n_entries] = column
@@ -0,0 +1,154 @@
+"""
+State encoder for the DQN agents
+
+Writes the contextual representation of a dialog state straight into a float32
+row. The column offsets of every feature block are computed once from act_set,
+slot_set and max_turn, so encoding a state is a zero fill plus a few scatters.
+Block layout (A acts, S slots, T = max_turn):
+
+    user act (A) | user inform slots (S) | user request slots (S) | agent act (A) |
+    agent inform slots (S) | agent request slots (S) | current slots (S) | turn (1) |
+    turn one-hot (T) | KB binary (S + 1) | KB counts (S + 1) | extra columns
+
+All columns except the turn, the KB counts and the extra columns are binary. The
+sparse (packed) form of a state keeps only those few dense values followed by the
+indices of the active binary columns, padded with -1:
+
+    turn (1) | KB counts (S + 1) | extra columns | active binary columns (sparse_width)
+"""
+
+import numpy as np
+
+
+class StateEncoder:
+    """ Index-driven encoder of tracker states into a reusable float32 buffer """
+
+    def __init__(self, act_set, slot_set, max_turn, extra_dimension=0, sparse_width=64):
+        self.act_set = act_set
+        self.slot_set = slot_set
+        self.act_cardinality = len(act_set)
+        self.slot_cardinality = len(slot_set)
+        self.max_turn = max_turn
+        
+        A, S = self.act_cardinality, self.slot_cardinality
+        self.user_act_offset = 0
+        self.user_inform_offset = A
+        self.user_request_offset = A + S
+        self.agent_act_offset = A + 2 * S
+        self.agent_inform_offset = 2 * A + 2 * S
+        self.agent_request_offset = 2 * A + 3 * S
+        self.current_slots_offset = 2 * A + 4 * S
+        self.turn_offset = 2 * A + 5 * S
+        self.turn_onehot_offset = self.turn_offset + 1
+        self.kb_binary_offset = self.turn_onehot_offset + max_turn
+        self.kb_count_offset = self.kb_binary_offset + S + 1
+        self.contextual_dimension = self.kb_count_offset + S + 1
+        self.dimension = self.contextual_dimension + extra_dimension
+        
+        # Packed sparse layout
+        self.dense_columns = np.r_[self.turn_offset, self.kb_count_offset:self.dimension]
+        self.sparse_columns = np.setdiff1d(np.arange(self.contextual_dimension), self.dense_columns)
+        self.dense_dimension = len(self.dense_columns)
+        self.sparse_dimension = len(self.sparse_columns)
+        self.sparse_width = sparse_width
+        self.packed_dimension = self.dense_dimension + sparse_width
+        
+        self.buffer = np.zeros((1, self.dimension), dtype=np.float32)
+        self.encode_count = 0
+
+    def active_columns(self, state):
+        """ Columns of the one-hot blocks that are set for a state """
+        
+        user_action = state['user_action']
+        agent_last = state['agent_action']
+        slot_set = self.slot_set
+        
+        columns = [self.user_act_offset + self.act_set[user_action['diaact']]]
+        columns.extend([self.user_inform_offset + slot_set[slot] for slot in user_action['inform_slots']])
+        columns.extend([self.user_request_offset + slot_set[slot] for slot in user_action['request_slots']])
+        if agent_last:
+            columns.append(self.agent_act_offset + self.act_set[agent_last['diaact']])
+            columns.extend([self.agent_inform_offset + slot_set[slot] for slot in agent_last['inform_slots']])
+            columns.extend([self.agent_request_offset + slot_set[slot] for slot in agent_last['request_slots']])
+        columns.extend([self.current_slots_offset + slot_set[slot] for slot in state['current_slots']['inform_slots']])
+        columns.append(self.turn_onehot_offset + state['turn'])
+        return columns
+
+    def encode(self, state, out=None):
+        """ Encode the contextual part of a state into out (a row of a batch matrix) or into the internal buffer; returns a (1, dimension) view
+
+        The extra columns (topology features) are left for the caller to fill.
+        """
+        
+        row = self.buffer[0] if out is None else out
+        row[:self.contextual_dimension] = 0.
+        row[self.active_columns(state)] = 1.
+        row[self.turn_offset] = state['turn'] / 10.
+        
+        kb_results_dict = state['kb_results_dict']
+        matching_all = kb_results_dict['matching_all_constraints']
+        row[self.kb_binary_offset:self.kb_count_offset] = matching_all > 0.
+        row[self.kb_count_offset:self.contextual_dimension] = matching_all / 100.
+        for slot in kb_results_dict:
+            if slot in self.slot_set:
+                row[self.kb_binary_offset + self.slot_set[slot]] = kb_results_dict[slot] > 0.
+                row[self.kb_count_offset + self.slot_set[slot]] = kb_results_dict[slot] / 100.
+        
+        self.encode_count += 1
+        return row.reshape(1, -1)
+
+    def encode_batch(self, states, out=None):
+        """ Encode the contextual part of many states into the rows of a (B, dimension) float32 matrix (allocated when out is None) """
+        
+        if out is None:
+            out = np.zeros((len(states), self.dimension), dtype=np.float32)
+        else:
+            out[:, :self.contextual_dimension] = 0.
+        
+        rows, columns = [], []
+        for i, state in enumerate(states):
+            active = self.active_columns(state)
+            rows.extend([i] * len(active))
+            columns.extend(active)
+        out[rows, columns] = 1.
+        out[:, self.turn_offset] = [state['turn'] / 10. for state in states]
+        
+        for i, state in enumerate(states):
+            kb_results_dict = state['kb_results_dict']
+            matching_all = kb_results_dict['matching_all_constraints']
+            out[i, self.kb_binary_offset:self.kb_count_offset] = matching_all > 0.
+            out[i, self.kb_count_offset:self.contextual_dimension] = matching_all / 100.
+            for slot in kb_results_dict:
+                if slot in self.slot_set:
+                    out[i, self.kb_binary_offset + self.slot_set[slot]] = kb_results_dict[slot] > 0.
+                    out[i, self.kb_count_offset + self.slot_set[slot]] = kb_results_dict[slot] / 100.
+        
+        self.encode_count += len(states)
+        return out
+
+    def pack(self, rows, out=None):
+        """ Packed sparse form (B, packed_dimension) of encoded (B, dimension) rows """
+        
+        active = rows[:, self.sparse_columns] != 0
+        counts = active.sum(1)
+        if len(counts) > 0 and counts.max() > self.sparse_width:
+            raise Exception("%d active state features do not fit in sparse_width=%d" % (counts.max(), self.sparse_width))
+        
+        if out is None:
+            out = np.empty((len(rows), self.packed_dimension), dtype=np.float32)
+        out[:, :self.dense_dimension] = rows[:, self.dense_columns]
+        out[:, self.dense_dimension:] = -1.
+        row_ids, sparse_ids = np.nonzero(active)
+        positions = np.arange(len(row_ids)) - np.repeat(np.cumsum(counts) - counts, counts)
+        out[row_ids, self.dense_dimension + positions] = sparse_ids
+        return out
+
+    def unpack(self, packed):
+        """ Encoded (B, dimension) rows of packed sparse states """
+        
+        rows = np.zeros((len(packed), self.dimension), dtype=np.float32)
+        rows[:, self.dense_columns] = packed[:, :self.dense_dimension]
+        sparse_ids = packed[:, self.dense_dimension:].astype(np.int64)
+        row_ids, positions = np.nonzero(sparse_ids >= 0)
+        rows[row_ids, self.sparse_columns[sparse_ids[row_ids, positions]]] = 1.
+        return rows
@@ -1,64 +1,61 @@
+"""
+Sum tree over replay priorities
+
+The tree is an array heap (root at 1, children of node i at 2i and 2i + 1) over a
+power-of-two number of leaves, one leaf per replay slot. Every node holds the sum
+and, in a parallel min-tree, the minimum of the priorities below it. Prefix-sum
+lookups and priority updates go level by level for a whole vector of samples at
+once.
+"""
+
 import numpy
 
 
 class SumTree:
-    write = 0
+    """ Sums and minimums of the priorities of capacity replay slots """
 
     def __init__(self, capacity):
         self.capacity = capacity
-        self.tree = numpy.zeros(2 * capacity - 1)
-        self.data = numpy.zeros(capacity, dtype=object)
-        self.n_entries = 0
-
-    # update to the root node
-    def _propagate(self, idx, change):
-        parent = (idx - 1) // 2
-
-        self.tree[parent] += change
-
-        if parent != 0:
-            self._propagate(parent, change)
-
-    # find sample on leaf node
-    def _retrieve(self, idx, s):
-        left = 2 * idx + 1
-        right = left + 1
-
-        if left >= len(self.tree):
-            return idx
-
-        if s <= self.tree[left]:
-            return self._retrieve(left, s)
-        else:
-            return self._retrieve(right, s - self.tree[left])
+        self.depth = int(numpy.ceil(numpy.log2(max(capacity, 1))))
+        self.leaf_offset = 1 << self.depth
+        self.tree = numpy.zeros(2 * self.leaf_offset)
+        self.min_tree = numpy.full(2 * self.leaf_offset, numpy.inf)  # empty slots never are the minimum
 
     def total(self):
-        return self.tree[0]
-
-    # store priority and sample
-    def add(self, p, data):
-        idx = self.write + self.capacity - 1
-
-        self.data[self.write] = data
-        self.update(idx, p)
+        return self.tree[1]
 
-        self.write += 1
-        if self.write >= self.capacity:
-            self.write = 0
+    def min(self):
+        return self.min_tree[1]
 
-        if self.n_entries < self.capacity:
-            self.n_entries += 1
+    def priorities(self, idx):
+        return self.tree[self.leaf_offset + numpy.asarray(idx)]
 
-    # update priority
     def update(self, idx, p):
-        change = p - self.tree[idx]
-
-        self.tree[idx] = p
-        self._propagate(idx, change)
-
-    # get priority and sample
-    def get(self, s):
-        idx = self._retrieve(0, s)
-        dataIdx = idx - self.capacity + 1
-
-        return (idx, self.tree[idx], self.data[dataIdx])
+        """ Set the priorities p of the slots idx (scalars or vectors), then recompute their ancestors once each """
+
+        nodes = self.leaf_offset + numpy.atleast_1d(numpy.asarray(idx, dtype=numpy.int64))
+        self.tree[nodes] = p
+        self.min_tree[nodes] = p
+        nodes = numpy.unique(nodes)
+        for level in range(self.depth):
+            # parents of sorted nodes are sorted: shared ancestors are neighbours
+            nodes = nodes >> 1
+            if len(nodes) > 1:
+                nodes = nodes[numpy.r_[True, nodes[1:] != nodes[:-1]]]
+            left = nodes << 1
+            self.tree[nodes] = self.tree[left] + self.tree[left + 1]
+            self.min_tree[nodes] = numpy.minimum(self.min_tree[left], self.min_tree[left + 1])
+
+    def find(self, s):
+        """ Slots whose cumulative priority intervals contain the prefix sums s """
+
+        s = numpy.array(s, dtype=numpy.float64, ndmin=1)
+        nodes = numpy.ones(len(s), dtype=numpy.int64)
+        for level in range(self.depth):
+            left = nodes << 1
+            left_sum = self.tree[left]
+            # rounding can leave s above the total: never descend into an empty subtree
+            go_right = (s > left_sum) & (self.tree[left + 1] > 0)
+            s -= left_sum * go_right
+            nodes = left + go_right
+        return nodes - self.leaf_offset
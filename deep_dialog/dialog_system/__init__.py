@@ -1,5 +1,8 @@
 from .kb_helper import *
+from .dialog_state import *
 from .state_tracker import *
 from .dialog_manager import *
+from .vec_dialog_manager import *
+from .rollout_workers import *
 from .dict_reader import *
 from .utils import *
\ No newline at end of file
@@ -4,20 +4,21 @@ Created on May 17, 2016
 @author: xiul, t-zalipt
 """
 
-import json, copy, csv
+import json, copy
 from . import StateTracker
+from .transition_log import TransitionLogger
 from deep_dialog import dialog_config
 
 
 class DialogManager:
     """ A dialog manager to mediate the interaction between an agent and a customer """
 
-    def __init__(self, agent, user, act_set, slot_set, movie_dictionary, success_rate_threshold=0.8):
+    def __init__(self, agent, user, act_set, slot_set, movie_dictionary, success_rate_threshold=0.8, transition_graph=None):
         self.agent = agent
         self.user = user
         self.act_set = act_set
         self.slot_set = slot_set
-        self.state_tracker = StateTracker(act_set, slot_set, movie_dictionary)
+        self.state_tracker = StateTracker(act_set, slot_set, movie_dictionary, user.max_turn)
         self.user_action = None
         self.reward = 0
         self.instrinsic_reward = 0
@@ -25,6 +26,8 @@ class DialogManager:
         self.success_rate = 0  # Track success rate
         self.success_rate_threshold = success_rate_threshold
         self.experience = []  # To store (s, a, s', r, d) tuples
+        self.transition_graph = transition_graph  # cluster-level transition graph, fed every turn
+        self.next_state = None
 
 
     def initialize_episode(self):
@@ -33,6 +36,7 @@ class DialogManager:
         self.reward = 0
         self.instrinsic_reward = 0
         self.episode_over = False
+        self.next_state = None
         self.state_tracker.initialize_episode()
         self.user_action = self.user.initialize_episode()
         self.state_tracker.update(user_action = self.user_action)
@@ -56,8 +60,38 @@ class DialogManager:
         ########################################################################
         #   CALL AGENT TO TAKE HER TURN
         ########################################################################
-        self.state = self.state_tracker.get_state_for_agent()
+        self.state = self.state_for_agent()
         self.agent_action = self.agent.state_to_action(self.state)
+        if self.transition_graph is not None:
+            self.cluster_t = self.agent.state_cluster(self.state)
+        
+        self.respond(self.agent_action)
+
+        ########################################################################
+        #  Inform agent of the outcome for this timestep (s_t, a_t, r, s_{t+1}, episode_over)
+        ########################################################################
+        if record_training_data:
+            self.agent.register_experience_replay_tuple(self.state, self.agent_action, self.reward, self.next_state, self.episode_over)
+        
+        ########################################################################
+        #  Record the (cluster(s_t), a_t, cluster(s_{t+1})) edge
+        ########################################################################
+        if self.transition_graph is not None:
+            self.transition_graph.add(self.cluster_t, self.agent.action, self.agent.state_cluster(self.next_state), self.reward)
+        
+        return (self.episode_over, self.reward)
+
+    def state_for_agent(self):
+        """ The state the agent acts on: s_{t+1} of the previous turn while the tracker is still on that turn """
+        
+        if self.next_state is not None and self.next_state['turn'] == self.state_tracker.turn_count:
+            return self.next_state  # already encoded by the agent
+        return self.state_tracker.get_state_for_agent()
+
+    def respond(self, agent_action):
+        """ Register the agent action, let the user respond and update the state; returns s_{t+1} """
+        
+        self.agent_action = agent_action
         
         ########################################################################
         #   Register AGENT action with the state_tracker
@@ -82,13 +116,8 @@ class DialogManager:
             self.state_tracker.update(user_action = self.user_action)
             self.print_function(user_action = self.user_action)
 
-        ########################################################################
-        #  Inform agent of the outcome for this timestep (s_t, a_t, r, s_{t+1}, episode_over)
-        ########################################################################
-        if record_training_data:
-            self.agent.register_experience_replay_tuple(self.state, self.agent_action, self.reward, self.state_tracker.get_state_for_agent(), self.episode_over)
-        
-        return (self.episode_over, self.reward)
+        self.next_state = self.state_tracker.get_state_for_agent()
+        return self.next_state
 
     
     def reward_function(self, dialog_status):
@@ -113,33 +142,11 @@ class DialogManager:
     
    
 
-    def save_experience_to_csv(experience, filename="experience.csv"):
-        """Save (s, a, s', r, d) tuples to a CSV file."""
-        fieldnames = ['s', 'a', 's_prime', 'r', 'd']
-        
-        # Check if the file already exists, if not, write header
-        file_exists = False
-        try:
-            with open(filename, 'r'):
-                file_exists = True
-        except FileNotFoundError:
-            pass
-        
-        with open(filename, mode='a', newline='') as file:
-            writer = csv.DictWriter(file, fieldnames=fieldnames)
-            
-            # Write header if the file doesn't exist
-            if not file_exists:
-                writer.writeheader()
-            
+    def save_experience_to_log(self, experience, filename="experience.trlog"):
+        """Append (s, a, s', r, d) tuples to a binary transition log."""
+        with TransitionLogger(filename) as logger:
             for exp in experience:
-                writer.writerow({
-                    's': exp[0],
-                    'a': exp[1],
-                    's_prime': exp[2],
-                    'r': exp[3],
-                    'd': exp[4]
-                })
+                logger.append((exp[0], exp[1], exp[3], exp[2], exp[4]))
 
     def print_function(self, agent_action=None, user_action=None):
         """ Print Function """
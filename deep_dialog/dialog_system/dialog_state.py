@@ -0,0 +1,102 @@
+"""
+Immutable dialog state snapshots
+
+The state tracker records every turn as a frozen record in an append-only
+DialogHistory. A snapshot of the history is a HistoryView (the shared record list
+plus a length), so handing the state to the agent is O(1) instead of a deepcopy of
+the whole dialog, and nothing the agent does can change the tracker.
+"""
+
+
+def _readonly(self, *args, **kwargs):
+    raise TypeError("dialog state records are read-only")
+
+
+class FrozenDict(dict):
+    """ A dict that cannot be modified after construction (copies and deep copies are itself) """
+
+    __setitem__ = __delitem__ = _readonly
+    clear = pop = popitem = setdefault = update = __ior__ = _readonly
+
+    def __copy__(self):
+        return self
+
+    def __deepcopy__(self, memo):
+        return self
+
+    def __reduce__(self):
+        return (FrozenDict, (dict(self), ))
+
+
+def freeze(value):
+    """ Read-only copy of a (nested) record: dicts become FrozenDicts, lists become tuples """
+
+    if isinstance(value, FrozenDict):
+        return value
+    if isinstance(value, dict):
+        return FrozenDict((k, freeze(v)) for k, v in value.items())
+    if isinstance(value, (list, tuple)):
+        return tuple(freeze(v) for v in value)
+    return value
+
+
+class HistoryView:
+    """ Read-only view of the first length records of a dialog history """
+
+    __slots__ = ('records', 'length')
+
+    def __init__(self, records, length):
+        self.records = records
+        self.length = length
+
+    def __len__(self):
+        return self.length
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return tuple(self.records[i] for i in range(*index.indices(self.length)))
+        if index < 0:
+            index += self.length
+        if index < 0 or index >= self.length:
+            raise IndexError("dialog history index out of range")
+        return self.records[index]
+
+    def __iter__(self):
+        for i in range(self.length):
+            yield self.records[i]
+
+    def __eq__(self, other):
+        return len(self) == len(other) and all(a == b for a, b in zip(self, other))
+
+    def __copy__(self):
+        return self
+
+    def __deepcopy__(self, memo):
+        return self
+
+    def __reduce__(self):
+        return (HistoryView, (self.records[:self.length], self.length))
+
+    def __repr__(self):
+        return 'HistoryView(%r)' % (list(self), )
+
+
+class DialogHistory:
+    """ Append-only list of frozen turn records; views taken earlier keep seeing their prefix """
+
+    def __init__(self):
+        self.records = []
+
+    def append(self, record):
+        record = freeze(record)
+        self.records.append(record)
+        return record
+
+    def view(self):
+        return HistoryView(self.records, len(self.records))
+
+    def __len__(self):
+        return len(self.records)
+
+    def __getitem__(self, index):
+        return self.records[index]
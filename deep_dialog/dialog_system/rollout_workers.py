@@ -0,0 +1,128 @@
+"""
+Multiprocess rollout workers
+
+Forked worker processes run simulated dialogs with their own copy of the dialog
+manager (state tracker, KB helper, user simulator and agent). The Q-network
+parameters are moved to shared memory before forking, so every worker acts with
+the learner's current weights without copying them. Episodes are handed out as
+tasks carrying their own seeds, and finished episodes stream back to the learner
+(transitions and outcome). The learner consumes them in task order, but workers
+read the shared weights while they change: a rollout only gives the same results
+whatever the number of workers when nothing trains during run(), i.e. with a
+stopped learner thread and an on_episode callback that does not update the network
+(warm start, evaluation).
+"""
+
+import random
+import multiprocessing as mp
+import numpy as np
+import torch
+
+
+def rollout_worker(dialog_manager, tasks, results, cancel):
+    """ Worker loop: run the episodes of each task and send them back one by one """
+
+    torch.set_num_threads(1)
+    agent = dialog_manager.agent
+    agent.experience_replay_pool = []
+    agent.transition_logger = None  # the learner logs the transitions it stores
+    while True:
+        task = tasks.get()
+        if task is None:
+            break
+        task_id, n_episodes, seed, params = task
+        random.seed(seed)
+        np.random.seed(seed)
+        torch.manual_seed(seed)
+        agent.epsilon = params['epsilon']
+        agent.warm_start = params['warm_start']
+        agent.predict_mode = True  # keep every transition, the learner filters them
+
+        for episode in range(n_episodes):
+            if cancel.is_set():
+                results.put((task_id, episode, None))
+                continue
+            del agent.experience_replay_pool[:]
+            dialog_manager.initialize_episode()
+            episode_over = False
+            cumulative_reward = 0
+            while not episode_over:
+                episode_over, reward = dialog_manager.next_turn(params['record'])
+                cumulative_reward += reward
+            transitions = list(agent.experience_replay_pool) if params['record'] else []
+            results.put((task_id, episode, {'transitions': transitions, 'reward': reward, 'cumulative_reward': cumulative_reward,
+                'turns': dialog_manager.state_tracker.turn_count}))
+
+
+class RolloutWorkers:
+    """ Pool of forked processes running simulated dialogs with the learner's shared Q-network """
+
+    def __init__(self, dialog_manager, n_workers, seed=0, episodes_per_task=5):
+        if 'fork' not in mp.get_all_start_methods():
+            raise Exception("rollout workers need the fork start method")
+
+        self.agent = dialog_manager.agent
+        self.n_workers = n_workers
+        self.seed = seed
+        self.episodes_per_task = episodes_per_task
+        self.task_count = 0
+
+        # parameters are updated in place by the optimizers, the workers see every update
+        self.agent.dqn.share_memory()
+        context = mp.get_context('fork')
+        self.tasks = context.Queue()
+        self.results = context.Queue()
+        self.cancel = context.Event()
+        self.workers = [context.Process(target=rollout_worker, args=(dialog_manager, self.tasks, self.results, self.cancel), daemon=True)
+                        for i in range(n_workers)]
+        for worker in self.workers:
+            worker.start()
+
+    def run(self, n_episodes, on_episode=None, stop=None):
+        """ Run n_episodes dialogs with the agent's current epsilon and warm start mode
+
+        on_episode(episode) receives each finished episode (transitions, reward, cumulative_reward, turns)
+        in task order; once stop() returns True the remaining episodes are cancelled.
+        """
+
+        params = {'epsilon': self.agent.epsilon, 'warm_start': self.agent.warm_start,
+                  'record': bool(self.agent.predict_mode or self.agent.warm_start == 1)}
+        # a previous run may have been cancelled: clear it before any worker can take a new task
+        self.cancel.clear()
+        n_tasks = 0
+        for start in range(0, n_episodes, self.episodes_per_task):
+            # seeds depend on the task number only, not on the worker that runs it
+            seed = self.seed * 1000003 + self.task_count + n_tasks
+            self.tasks.put((n_tasks, min(self.episodes_per_task, n_episodes - start), seed, params))
+            n_tasks += 1
+        self.task_count += n_tasks
+
+        res = {'episodes': 0, 'successes': 0, 'cumulative_reward': 0, 'cumulative_turns': 0}
+        pending = {}
+        next_key = (0, 0)
+        for i in range(n_episodes):
+            task_id, episode, result = self.results.get()
+            pending[(task_id, episode)] = result
+            while next_key in pending:
+                result = pending.pop(next_key)
+                next_key = (next_key[0], next_key[1] + 1) if next_key[1] + 1 < self.episodes_per_task else (next_key[0] + 1, 0)
+                if result is None or self.cancel.is_set():
+                    continue
+                res['episodes'] += 1
+                res['cumulative_reward'] += result['cumulative_reward']
+                res['cumulative_turns'] += result['turns']
+                if result['reward'] > 0:
+                    res['successes'] += 1
+                if on_episode is not None:
+                    on_episode(result)
+                if stop is not None and stop():
+                    self.cancel.set()
+        return res
+
+    def close(self):
+        """ Stop the workers """
+
+        for worker in self.workers:
+            self.tasks.put(None)
+        for worker in self.workers:
+            worker.join()
@@ -7,6 +7,7 @@ state tracker
 """
 
 from . import KBHelper
+from .dialog_state import DialogHistory, FrozenDict, freeze
 import numpy as np
 import copy
 
@@ -14,25 +15,27 @@ import copy
 class StateTracker:
     """ The state tracker maintains a record of which request slots are filled and which inform slots are filled """
 
-    def __init__(self, act_set, slot_set, movie_dictionary):
+    def __init__(self, act_set, slot_set, movie_dictionary, max_turn=40):
         """ constructor for statetracker takes movie knowledge base and initializes a new episode
 
         Arguments:
         act_set                 --  The set of all acts availavle
         slot_set                --  The total set of available slots
         movie_dictionary        --  A representation of all the available movies. Generally this object is accessed via the KBHelper class
+        max_turn                --  The maximum number of turns of a dialog, used to preallocate history_vectors
 
         Class Variables:
-        history_vectors         --  A record of the current dialog so far in vector format (act-slot, but no values)
-        history_dictionaries    --  A record of the current dialog in dictionary format
+        history_vectors         --  A record of the current dialog so far in vector format (act-slot, but no values), preallocated rows of which the first history_length are used
+        history_dictionaries    --  A record of the current dialog in dictionary format (append-only DialogHistory of frozen records)
         current_slots           --  A dictionary that keeps a running record of which slots are filled current_slots['inform_slots'] and which are requested current_slots['request_slots'] (but not filed)
         action_dimension        --  # TODO indicates the dimensionality of the vector representaiton of the action
         kb_result_dimension     --  A single integer denoting the dimension of the kb_results features.
         turn_count              --  A running count of which turn we are at in the present dialog
         """
         self.movie_dictionary = movie_dictionary
-        self.initialize_episode()
+        self.max_turn = max_turn
         self.history_vectors = None
+        self.initialize_episode()
         self.history_dictionaries = None
         self.current_slots = None
         self.action_dimension = 10      # TODO REPLACE WITH REAL VALUE
@@ -45,8 +48,13 @@ class StateTracker:
         """ Initialize a new episode (dialog), flush the current state and tracked slots """
         
         self.action_dimension = 10
-        self.history_vectors = np.zeros((1, self.action_dimension))
-        self.history_dictionaries = []
+        if self.history_vectors is None or self.history_vectors.shape[1] != self.action_dimension:
+            self.history_vectors = np.zeros((2 * self.max_turn + 4, self.action_dimension))
+        else:
+            self.history_vectors[:self.history_length] = 0
+        self.history_length = 1
+        self.history_dictionaries = DialogHistory()
+        self.frozen_slots = None
         self.turn_count = 0
         self.current_slots = {}
         
@@ -58,12 +66,20 @@ class StateTracker:
 
     def dialog_history_vectors(self):
         """ Return the dialog history (both user and agent actions) in vector representation """
-        return self.history_vectors
+        return self.history_vectors[:self.history_length]
+
+    def append_history_vector(self, value):
+        """ Write the vector of the latest action at the history cursor (the buffer only grows if a dialog outlives max_turn) """
+        
+        if self.history_length == len(self.history_vectors):
+            self.history_vectors = np.vstack([self.history_vectors, np.zeros_like(self.history_vectors)])
+        self.history_vectors[self.history_length] = value
+        self.history_length += 1
 
 
     def dialog_history_dictionaries(self):
         """  Return the dictionary representation of the dialog history (includes values) """
-        return self.history_dictionaries
+        return self.history_dictionaries.view()
 
 
     def kb_results_for_state(self):
@@ -78,12 +94,15 @@ class StateTracker:
         
 
     def get_state_for_agent(self):
-        """ Get the state representatons to send to agent """
+        """ Get the state representatons to send to agent (an immutable snapshot sharing the history records, no copy of the dialog) """
         #state = {'user_action': self.history_dictionaries[-1], 'current_slots': self.current_slots, 'kb_results': self.kb_results_for_state()}
-        state = {'user_action': self.history_dictionaries[-1], 'current_slots': self.current_slots, #'kb_results': self.kb_results_for_state(), 
-                 'kb_results_dict':self.kb_helper.database_results_for_agent(self.current_slots), 'turn': self.turn_count, 'history': self.history_dictionaries, 
-                 'agent_action': self.history_dictionaries[-2] if len(self.history_dictionaries) > 1 else None}
-        return copy.deepcopy(state)
+        history = self.history_dictionaries.view()
+        if self.frozen_slots is None:
+            self.frozen_slots = freeze(self.current_slots)
+        state = {'user_action': history[-1], 'current_slots': self.frozen_slots, #'kb_results': self.kb_results_for_state(), 
+                 'kb_results_dict': freeze(self.kb_helper.database_results_for_agent(self.current_slots)), 'turn': self.turn_count, 'history': history, 
+                 'agent_action': history[-2] if len(history) > 1 else None}
+        return FrozenDict(state)
     
     def get_suggest_slots_values(self, request_slots):
         """ Get the suggested values for request slots """
@@ -145,8 +164,7 @@ class StateTracker:
                     self.current_slots['agent_request_slots'][slot] = "UNK"
 
             self.history_dictionaries.append(agent_action_values)
-            current_agent_vector = np.ones((1, self.action_dimension))
-            self.history_vectors = np.vstack([self.history_vectors, current_agent_vector])
+            self.append_history_vector(1.)
                                       
         ########################################################################
         #   Update the state to reflect a new action by the user
@@ -165,9 +183,9 @@ class StateTracker:
                 if slot not in self.current_slots['request_slots']:
                     self.current_slots['request_slots'][slot] = "UNK"
             
-            self.history_vectors = np.vstack([self.history_vectors, np.zeros((1,self.action_dimension))])
+            self.append_history_vector(0.)
             new_move = {'turn': self.turn_count, 'speaker': "user", 'request_slots': user_action['request_slots'], 'inform_slots': user_action['inform_slots'], 'diaact': user_action['diaact']}
-            self.history_dictionaries.append(copy.deepcopy(new_move))
+            self.history_dictionaries.append(new_move)
 
         ########################################################################
         #   This should never happen if the asserts passed
@@ -178,4 +196,5 @@ class StateTracker:
         ########################################################################
         #   This code should execute after update code regardless of what kind of action (agent/user)
         ########################################################################
+        self.frozen_slots = None
         self.turn_count += 1
\ No newline at end of file
@@ -0,0 +1,222 @@
+"""
+Binary transition log format (.trlog)
+
+A streaming, append-only log of (s_t, a_t, r, s_{t+1}, episode_over) transitions for
+graph building and offline analysis. Layout:
+
+    b'GSRLTLOG' | uint32 version | uint32 header length | JSON header | chunks | JSON footer | trailer
+
+The JSON header records the columns (name, dtype, width) and free-form meta. A
+chunk starts on a 64-byte boundary with its uint32 row count, followed by one
+contiguous array per column, each on a 64-byte boundary: states and next states
+are float32 (rows, D), actions int64, rewards float32 and done flags uint8. The
+footer indexes the chunks (offset, rows) and the trailer
+(uint64 footer offset | uint32 footer length | b'GSRLTLOG') locates it.
+
+The writer buffers one chunk in preallocated arrays, so memory is bounded and an
+append is O(1). Reopening a log truncates the footer and appends new chunks. A
+log whose writer did not close has no footer and is read (or reopened) up to its
+last complete chunk.
+"""
+
+import json, os, struct
+
+import numpy as np
+
+
+MAGIC = b'GSRLTLOG'
+VERSION = 1
+ALIGNMENT = 64
+TRAILER = struct.Struct('<QI')
+
+
+def align(n):
+    return -(-n // ALIGNMENT) * ALIGNMENT
+
+
+def transition_columns(state_dimension):
+    return [['state', '<f4', state_dimension], ['action', '<i8', 1], ['reward', '<f4', 1],
+            ['next_state', '<f4', state_dimension], ['done', '|u1', 1]]
+
+
+def chunk_layout(columns, rows):
+    """ Byte offsets of the columns in a chunk of rows transitions, and the size of the chunk """
+
+    offsets = {}
+    offset = ALIGNMENT  # row count
+    for name, dtype, width in columns:
+        offsets[name] = offset
+        offset += align(rows * width * np.dtype(dtype).itemsize)
+    return offsets, offset
+
+
+def read_header(f):
+    """ (columns, meta, offset of the first chunk) of an open log """
+
+    f.seek(0)
+    if f.read(len(MAGIC)) != MAGIC:
+        raise Exception('%s is not a transition log' % (f.name, ))
+    version, header_length = struct.unpack('<II', f.read(8))
+    if version > VERSION:
+        raise Exception('%s has format version %d, this reader supports up to %d' % (f.name, version, VERSION))
+    header = json.loads(f.read(header_length).decode('utf-8'))
+    return header['columns'], header['meta'], align(len(MAGIC) + 8 + header_length)
+
+
+def read_chunk_index(f, columns, data_start):
+    """ [(offset, rows)] of the chunks of an open log, from its footer or, without one, by walking the complete chunks """
+
+    size = f.seek(0, os.SEEK_END)
+    if size >= data_start + TRAILER.size + len(MAGIC):
+        f.seek(size - TRAILER.size - len(MAGIC))
+        footer_offset, footer_length = TRAILER.unpack(f.read(TRAILER.size))
+        if f.read(len(MAGIC)) == MAGIC and footer_offset + footer_length <= size:
+            f.seek(footer_offset)
+            return [tuple(chunk) for chunk in json.loads(f.read(footer_length).decode('utf-8'))['chunks']]
+
+    chunks = []
+    offset = data_start
+    while offset + 4 <= size:
+        f.seek(offset)
+        rows = struct.unpack('<I', f.read(4))[0]
+        chunk_size = chunk_layout(columns, rows)[1]
+        if rows == 0 or offset + chunk_size > size:
+            break
+        chunks.append((offset, rows))
+        offset += chunk_size
+    return chunks
+
+
+class TransitionLogger:
+    """ Append transitions to a .trlog file in chunks of chunk_rows; at most max_rows transitions in total when given """
+
+    def __init__(self, path, state_dimension=None, chunk_rows=4096, max_rows=None, meta=None):
+        self.path = path
+        self.chunk_rows = chunk_rows
+        self.max_rows = max_rows
+        self.meta = meta or {}
+        self.file = None
+        self.columns = None
+        self.chunks = []
+        self.rows = 0  # rows in written chunks
+        self.buffered = 0
+
+        if os.path.exists(path):
+            self.file = open(path, 'r+b')
+            self.columns, self.meta, data_start = read_header(self.file)
+            self.chunks = read_chunk_index(self.file, self.columns, data_start)
+            self.rows = sum(rows for offset, rows in self.chunks)
+            end = self.chunks[-1][0] + chunk_layout(self.columns, self.chunks[-1][1])[1] if self.chunks else data_start
+            self.file.truncate(end)
+            self.file.seek(end)
+            if state_dimension is not None and state_dimension != self.columns[0][2]:
+                raise Exception('%s holds states of dimension %d' % (path, self.columns[0][2]))
+            self.allocate()
+        elif state_dimension is not None:
+            self.create(state_dimension)
+
+    def create(self, state_dimension):
+        self.columns = transition_columns(int(state_dimension))
+        header_bytes = json.dumps({'columns': self.columns, 'meta': self.meta}).encode('utf-8')
+        self.file = open(self.path, 'w+b')
+        self.file.write(MAGIC)
+        self.file.write(struct.pack('<II', VERSION, len(header_bytes)))
+        self.file.write(header_bytes)
+        self.file.seek(align(len(MAGIC) + 8 + len(header_bytes)))
+        self.allocate()
+
+    def allocate(self):
+        self.buffer = {name: np.zeros((self.chunk_rows, width), dtype=dtype) for name, dtype, width in self.columns}
+
+    def append(self, transition):
+        """ Log (s_t, a_t, r, s_{t+1}, episode_over); returns False once max_rows transitions are logged """
+
+        if self.max_rows is not None and len(self) >= self.max_rows:
+            return False
+        state, action, reward, next_state, done = transition
+        if self.file is None:
+            self.create(np.size(state))
+        i = self.buffered
+        self.buffer['state'][i] = np.ravel(state)
+        self.buffer['action'][i] = action
+        self.buffer['reward'][i] = reward
+        self.buffer['next_state'][i] = np.ravel(next_state)
+        self.buffer['done'][i] = done
+        self.buffered += 1
+        if self.buffered == self.chunk_rows:
+            self.write_chunk()
+        return True
+
+    def write_chunk(self):
+        if self.buffered == 0:
+            return
+        rows = self.buffered
+        offset = align(self.file.tell())
+        offsets, chunk_size = chunk_layout(self.columns, rows)
+        self.file.seek(offset)
+        self.file.write(struct.pack('<I', rows))
+        for name, dtype, width in self.columns:
+            self.file.seek(offset + offsets[name])
+            self.file.write(self.buffer[name][:rows].tobytes())
+        self.file.truncate(offset + chunk_size)  # pads the last column
+        self.file.seek(offset + chunk_size)
+        self.chunks.append((offset, rows))
+        self.rows += rows
+        self.buffered = 0
+
+    def flush(self):
+        """ Write the buffered transitions as a chunk """
+
+        if self.file is not None:
+            self.write_chunk()
+            self.file.flush()
+
+    def close(self):
+        """ Write the last chunk and the chunk index """
+
+        if self.file is None:
+            return
+        self.write_chunk()
+        footer_offset = self.file.tell()
+        footer_bytes = json.dumps({'rows': self.rows, 'chunks': self.chunks}).encode('utf-8')
+        self.file.write(footer_bytes)
+        self.file.write(TRAILER.pack(footer_offset, len(footer_bytes)))
+        self.file.write(MAGIC)
+        self.file.close()
+        self.file = None
+
+    def __len__(self):
+        return self.rows + self.buffered
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def read_transition_log(path):
+    """ Memory-map a .trlog file: returns (chunks, meta), each chunk a dict of read-only column arrays """
+
+    with open(path, 'rb') as f:
+        columns, meta, data_start = read_header(f)
+        chunk_index = read_chunk_index(f, columns, data_start)
+
+    chunks = []
+    for offset, rows in chunk_index:
+        offsets = chunk_layout(columns, rows)[0]
+        chunk = {}
+        for name, dtype, width in columns:
+            shape = (rows, width) if name in ('state', 'next_state') else (rows, )
+            chunk[name] = np.memmap(path, dtype=np.dtype(dtype), mode='r', offset=offset + offsets[name], shape=shape)
+        chunks.append(chunk)
+    return chunks, meta
+
+
+def load_transition_log(path):
+    """ All the transitions of a .trlog file as one dict of column arrays """
+
+    chunks, meta = read_transition_log(path)
+    if len(chunks) == 0:
+        return {}
+    return {name: np.concatenate([chunk[name] for chunk in chunks]) for name in chunks[0]}
@@ -0,0 +1,110 @@
+"""
+Vectorized dialog manager
+
+Steps n_envs independent dialogs, each with its own state tracker and user simulator,
+in lockstep with one agent: the states of all active dialogs are encoded in one batch
+and scored with one policy call per step, and finished dialogs are reset automatically.
+"""
+
+import copy, time
+import numpy as np
+
+from .dialog_manager import DialogManager
+
+
+class VecDialogManager:
+    """ Runs n_envs dialogs between one agent and copies of a user simulator in lockstep """
+
+    def __init__(self, agent, user, act_set, slot_set, movie_dictionary, n_envs=8, transition_graph=None):
+        if not hasattr(agent, 'states_to_actions'):
+            raise Exception("%s cannot act in several dialogs at once" % (agent.__class__.__name__, ))
+
+        self.agent = agent
+        self.n_envs = n_envs
+        self.transition_graph = transition_graph
+        # user simulators rebuild their dialog state in initialize_episode: copies only share the goals, NLG and NLU
+        self.managers = [DialogManager(agent, copy.copy(user), act_set, slot_set, movie_dictionary) for i in range(n_envs)]
+        self.step_count = 0
+        self.episode_count = 0
+
+    def run(self, n_episodes, record_training_data=True, on_step=None, stop=None):
+        """ Run n_episodes dialogs
+
+        on_step(n) is called after every lockstep with the number of transitions it produced;
+        stop() is checked whenever a dialog ends, no new dialog is started once it returns True.
+        """
+
+        res = {'episodes': 0, 'successes': 0, 'cumulative_reward': 0, 'cumulative_turns': 0}
+        contexts = [None] * self.n_envs
+        representations = [None] * self.n_envs
+        cluster_ids = [None] * self.n_envs
+
+        active = list(range(min(self.n_envs, n_episodes)))
+        for i in active:
+            contexts[i] = self.start_episode(i)
+        started = len(active)
+        pending = list(active)  # dialogs whose first state is not encoded yet
+
+        while len(active) > 0:
+            if len(pending) > 0:
+                first_reps, first_cluster_ids = self.agent.prepare_state_representation_batch([self.managers[i].state_for_agent() for i in pending])
+                for j, i in enumerate(pending):
+                    representations[i], cluster_ids[i] = first_reps[j:j+1], first_cluster_ids[j]
+                pending = []
+
+            ####################################################################
+            #   One policy call for all active dialogs, then every user responds
+            ####################################################################
+            actions = self.agent.states_to_actions(np.vstack([representations[i] for i in active]), [contexts[i] for i in active])
+            next_states = [self.managers[i].respond(self.agent.action_response(action)) for i, action in zip(active, actions)]
+            next_reps, next_cluster_ids = self.agent.prepare_state_representation_batch(next_states)
+
+            still_active = []
+            for j, i in enumerate(active):
+                manager = self.managers[i]
+                if record_training_data:
+                    self.agent.append_experience(representations[i], actions[j], manager.reward, next_reps[j:j+1], manager.episode_over)
+                if self.transition_graph is not None:
+                    self.transition_graph.add(cluster_ids[i], actions[j], next_cluster_ids[j], manager.reward)
+                representations[i], cluster_ids[i] = next_reps[j:j+1], next_cluster_ids[j]
+                res['cumulative_reward'] += manager.reward
+
+                if not manager.episode_over:
+                    still_active.append(i)
+                    continue
+                res['episodes'] += 1
+                res['cumulative_turns'] += manager.state_tracker.turn_count
+                if manager.reward > 0:
+                    res['successes'] += 1
+                self.episode_count += 1
+                if started < n_episodes and not (stop is not None and stop()):
+                    contexts[i] = self.start_episode(i)
+                    started += 1
+                    pending.append(i)
+                    still_active.append(i)
+            active = still_active
+
+            self.step_count += 1
+            if on_step is not None:
+                on_step(len(next_states))
+        return res
+
+    def start_episode(self, i):
+        """ Reset dialog i; returns the agent's context for it """
+
+        self.managers[i].initialize_episode()
+        return self.agent.new_episode_context()
+
+
+def benchmark(agent, user, act_set, slot_set, movie_dictionary, n_envs_list, n_episodes=100):
+    """ Episodes/sec of the current policy (nothing recorded) for each number of dialogs run in lockstep """
+
+    results = []
+    for n_envs in n_envs_list:
+        vec_dialog_manager = VecDialogManager(agent, user, act_set, slot_set, movie_dictionary, n_envs)
+        start = time.time()
+        vec_dialog_manager.run(n_episodes, record_training_data=False)
+        episodes_per_sec = n_episodes / (time.time() - start)
+        print(("%d dialogs in lockstep: %.1f episodes/sec" % (n_envs, episodes_per_sec)))
+        results.append((n_envs, episodes_per_sec))
+    return results
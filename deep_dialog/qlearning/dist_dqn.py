@@ -7,6 +7,7 @@ import torch.optim as optim
 import numpy as np
 
 from .network import *
+from .utils import batch_tensors
 
 use_cuda = torch.cuda.is_available()
 
@@ -52,15 +53,9 @@ class DistributionalDQN(nn.Module):
 
     def singleBatch(self, raw_batch, params):
         gamma = params.get('gamma', 0.9)
-        batch_size = len(raw_batch)
-        batch = [np.vstack(b) for b in zip(*raw_batch)]
-        
         # each example in a batch: [s, a, r, s_prime, term]
-        s = self.Variable(torch.FloatTensor(batch[0]))
-        a = self.Variable(torch.LongTensor(batch[1]))
-        r = self.Variable(torch.FloatTensor(batch[2]))
-        s_prime = self.Variable(torch.FloatTensor(batch[3]))
-        done = self.Variable(torch.FloatTensor(np.array(batch[4]).astype(np.float32)))
+        s, a, r, s_prime, done = [self.Variable(x) for x in batch_tensors(raw_batch)]
+        batch_size = s.size(0)
         #r = r.clamp(-1, 1)
 
         with torch.no_grad():
@@ -98,6 +93,15 @@ class DistributionalDQN(nn.Module):
         q = (prob * self.support).sum(-1)
         return q.max(-1)[1].item()
 
+    def predict_batch(self, inputs, get_q=False):
+        """ Greedy actions (B,) for a (B, D) batch of states: argmax of the expected Q over the atoms """
+        with torch.no_grad():
+            prob = self.model(self.Variable(torch.from_numpy(inputs).float()))
+            q, act = torch.max((prob * self.support).sum(-1), 1)
+        if get_q:
+            return act.cpu().numpy(), q.cpu().numpy()
+        return act.cpu().numpy()
+
     def save_model(self, model_path):
         torch.save(self.model.state_dict(), model_path)
         print("model saved.")
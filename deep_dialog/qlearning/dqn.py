@@ -8,17 +8,21 @@ import torch.optim as optim
 import numpy as np
 
 from .network import Network, DuelNetwork
+from .utils import batch_tensors
 
 use_cuda = torch.cuda.is_available()
 
 class DQN(nn.Module):
-    def __init__(self, input_size, hidden_size, output_size, duel=True, double=True, use_icm=True, noisy=True):
+    def __init__(self, input_size, hidden_size, output_size, duel=True, double=True, use_icm=True, noisy=True,
+            topology_embeddings=None, topology_lr=0.001, sparse_input=None, topology_column=-1):
         super(DQN, self).__init__()
 
         network = DuelNetwork if duel else Network
+        if sparse_input is not None and use_icm:
+            raise Exception("the ICM is not implemented for sparse states")
 
-        self.model = network(input_size, hidden_size, output_size, noisy)
-        self.target_model = network(input_size, hidden_size, output_size, noisy)
+        self.model = network(input_size, hidden_size, output_size, noisy, sparse_input)
+        self.target_model = network(input_size, hidden_size, output_size, noisy, sparse_input)
         self.target_model.load_state_dict(self.model.state_dict())
 
 
@@ -37,6 +41,14 @@ class DQN(nn.Module):
                 lr=lr)
         self.double = double
         self.use_icm = use_icm
+        
+        # Trainable topology embeddings: states carry their cluster id in the last column,
+        # the embedding row is looked up here and fine-tuned by the TD error (sparse gradients)
+        self.topology = None
+        self.topology_column = topology_column
+        if topology_embeddings is not None:
+            self.topology = nn.Embedding.from_pretrained(torch.FloatTensor(np.array(topology_embeddings)), freeze=False, sparse=True)
+            self.topology_optim = optim.SparseAdam(list(self.topology.parameters()), lr=topology_lr)
 
         if use_cuda:
             self.cuda()
@@ -53,18 +65,23 @@ class DQN(nn.Module):
         return x
         #return Variable(x, requires_grad=False).cuda() if use_cuda else Variable(x, requires_grad=False)
 
+    def featurize(self, x):
+        """ Replace the cluster id column of the states with the cluster's topology embedding """
+        if self.topology is None:
+            return x
+        column = self.topology_column % x.size(1)
+        return torch.cat([x[:, :column], self.topology(x[:, column].long()), x[:, column + 1:]], -1)
+
     def singleBatch(self, raw_batch, params):
 
         gamma = params.get('gamma', 0.9)
         
-        batch = [np.vstack(b) for b in zip(*raw_batch)]
         # each example in a batch: [s, a, r, s_prime, term]
-        s = self.Variable(torch.FloatTensor(batch[0]))
-        a = self.Variable(torch.LongTensor(batch[1]))
-        r = self.Variable(torch.FloatTensor(batch[2]))
-        s_prime = self.Variable(torch.FloatTensor(batch[3]))
-        done = self.Variable(torch.FloatTensor(np.array(batch[4]).astype(np.float32)))
+        s, a, r, s_prime, done = [self.Variable(x) for x in batch_tensors(raw_batch)]
         i_r = self.Variable(torch.zeros(1)) 
+        s = self.featurize(s)
+        with torch.no_grad():
+            s_prime = self.featurize(s_prime)
         if self.use_icm:
             s_pred = self.icm(torch.cat([s.detach(), self.action_emb(a.detach()).squeeze()], -1))
             icm_loss = F.mse_loss(s_pred, s_prime.detach(), reduce=False)
@@ -77,16 +94,7 @@ class DQN(nn.Module):
             self.icm_optim.step()
         
         q = self.model(s)
-        if self.double:
-            q_prime = self.model(s_prime).detach()
-            a_prime = q_prime.max(1)[1]
-            q_target_prime = self.target_model(s_prime).detach()
-            q_target_prime = q_target_prime.gather(1, a_prime.unsqueeze(1))
-            q_target = r + gamma * q_target_prime * (1 - done) 
-        else:
-            q_prime = self.target_model(s_prime).detach()
-            q_prime = q_prime.max(1)[0].unsqueeze(1)
-            q_target = r + gamma * q_prime * (1 - done)
+        q_target = self.q_target(r, s_prime, done, gamma)
         q_pred = torch.gather(q, 1, a)
         loss = F.mse_loss(q_pred, q_target)
         err = torch.abs(q_pred - q_target).detach()
@@ -101,9 +109,13 @@ class DQN(nn.Module):
         '''
         self.update_fixed_target_network()
         self.optimizer.zero_grad()
+        if self.topology is not None:
+            self.topology_optim.zero_grad()
         (loss + reg_loss).backward()
         clip_grad_norm_(self.model.parameters(), self.max_norm)
         self.optimizer.step()
+        if self.topology is not None:
+            self.topology_optim.step()
         
         self.model.sample_noise()
         self.target_model.sample_noise()
@@ -113,9 +125,29 @@ class DQN(nn.Module):
             'total_cost': (loss + reg_loss).item()}, 'error':err.cpu().numpy(),
             'intrinsic_reward': i_r.mean().cpu().numpy()}
 
+    def q_target(self, r, s_prime, done, gamma):
+        """ Bootstrapped targets r + gamma * Q_target(s', a') of featurized next states """
+        if self.double:
+            q_prime = self.model(s_prime).detach()
+            a_prime = q_prime.max(1)[1]
+            q_target_prime = self.target_model(s_prime).detach()
+            q_target_prime = q_target_prime.gather(1, a_prime.unsqueeze(1))
+            return r + gamma * q_target_prime * (1 - done)
+        q_prime = self.target_model(s_prime).detach()
+        q_prime = q_prime.max(1)[0].unsqueeze(1)
+        return r + gamma * q_prime * (1 - done)
+
+    def td_error(self, raw_batch, gamma=0.9):
+        """ |Q(s, a) - target| of a batch (see singleBatch) without training it; no intrinsic reward """
+        s, a, r, s_prime, done = [self.Variable(x) for x in batch_tensors(raw_batch)]
+        with torch.no_grad():
+            q_pred = torch.gather(self.model(self.featurize(s)), 1, a)
+            q_target = self.q_target(r, self.featurize(s_prime), done, gamma)
+        return torch.abs(q_pred - q_target).cpu().numpy()
+
     def get_intrinsic_reward(self, state, next_state, action):
-        state = self.Variable(torch.from_numpy(state.astype(np.float32)))
-        next_state = self.Variable(torch.from_numpy(next_state.astype(np.float32)))
+        state = self.featurize(self.Variable(torch.from_numpy(state.astype(np.float32))))
+        next_state = self.featurize(self.Variable(torch.from_numpy(next_state.astype(np.float32))))
         action = self.Variable(torch.from_numpy(action.astype(np.int64))).view(1, 1)
         state_pred = self.icm(torch.cat([state, self.action_emb(action).squeeze(0)], -1))
         icm_loss = F.mse_loss(state_pred, next_state.detach(), reduce=False)
@@ -125,13 +157,22 @@ class DQN(nn.Module):
 
 
     def predict(self, inputs, a, predict_model, get_q=False):
-        inputs = self.Variable(torch.from_numpy(inputs).float())
+        inputs = self.featurize(self.Variable(torch.from_numpy(inputs).float()))
         q, act = torch.max(self.model(inputs, True), 1)
         act = act.cpu().data.numpy()[0]
         if get_q:
             return act, q.item()
         return act
 
+    def predict_batch(self, inputs, get_q=False):
+        """ Greedy actions (B,) for a (B, D) batch of states, scored with one forward pass """
+        with torch.no_grad():
+            inputs = self.featurize(self.Variable(torch.from_numpy(inputs).float()))
+            q, act = torch.max(self.model(inputs, True), 1)
+        if get_q:
+            return act.cpu().numpy(), q.cpu().numpy()
+        return act.cpu().numpy()
+
     def save_model(self, model_path):
         torch.save(self.model.state_dict(), model_path)
         print("model saved.")
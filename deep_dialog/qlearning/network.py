@@ -44,12 +44,42 @@ class NoisyLinear(nn.Linear):
         self.epsilon_weight = torch.zeros(self.out_features, self.in_features)
         self.epsilon_bias = torch.zeros(self.out_features)
 
+class SparseLinear(nn.Module):
+    """ Linear layer over packed sparse states: dense values followed by the indices of the active binary features (-1 padded) """
+    def __init__(self, dense_size, sparse_size, out_features):
+        super(SparseLinear, self).__init__()
+        self.dense_size = dense_size
+        self.sparse_size = sparse_size
+        self.dense = nn.Linear(dense_size, out_features)
+        self.bag = nn.EmbeddingBag(sparse_size + 1, out_features, mode='sum', padding_idx=sparse_size)
+        self.reset_parameters()
+
+    def reset_parameters(self):
+        # same range as the dense nn.Linear over all dense_size + sparse_size inputs
+        bound = 1 / math.sqrt(self.dense_size + self.sparse_size)
+        nn.init.uniform_(self.dense.weight, -bound, bound)
+        nn.init.uniform_(self.dense.bias, -bound, bound)
+        with torch.no_grad():
+            nn.init.uniform_(self.bag.weight, -bound, bound)
+            self.bag.weight[self.sparse_size].fill_(0)
+
+    def forward(self, input):
+        indices = input[:, self.dense_size:].long()
+        indices = indices.masked_fill(indices < 0, self.sparse_size)
+        return self.dense(input[:, :self.dense_size]) + self.bag(indices)
+
+def input_layer(input_size, hidden_size, sparse_input=None):
+    """ First layer of a Q-network: nn.Linear, or SparseLinear when sparse_input = (dense_size, sparse_size) """
+    if sparse_input is None:
+        return nn.Linear(input_size, hidden_size)
+    return SparseLinear(sparse_input[0], sparse_input[1], hidden_size)
+
 class Network(nn.Module):
-    def __init__(self, input_size, hidden_size, output_size, noisy=False):
+    def __init__(self, input_size, hidden_size, output_size, noisy=False, sparse_input=None):
         super(Network, self).__init__()
         output_class = NoisyLinear if noisy else nn.Linear
         self.qf = nn.Sequential(OrderedDict([
-            ('w1', nn.Linear(input_size, hidden_size)), 
+            ('w1', input_layer(input_size, hidden_size, sparse_input)), 
             ('relu', nn.ReLU()), 
             ('w2', output_class(hidden_size, output_size))]))
         self.noisy = noisy
@@ -67,15 +97,15 @@ class Network(nn.Module):
         
 
 class DuelNetwork(nn.Module):
-    def __init__(self, input_size, hidden_size, output_size, noisy=False):
+    def __init__(self, input_size, hidden_size, output_size, noisy=False, sparse_input=None):
         super(DuelNetwork, self).__init__()
         output_class = NoisyLinear if noisy else nn.Linear
         self.adv = nn.Sequential(OrderedDict([
-            ('w1', nn.Linear(input_size, hidden_size)), 
+            ('w1', input_layer(input_size, hidden_size, sparse_input)), 
             ('relu', nn.ReLU()), 
             ('w2', output_class(hidden_size, output_size))]))
         self.vf = nn.Sequential(OrderedDict([
-            ('w1', nn.Linear(input_size, hidden_size)), 
+            ('w1', input_layer(input_size, hidden_size, sparse_input)), 
             ('relu', nn.ReLU()), 
             ('w2', output_class(hidden_size, 1))]))
         self.noisy = noisy
@@ -6,6 +6,7 @@ Created on Jun 18, 2016
 
 import numpy as np
 import math
+import torch
 
 
 def initWeight(n,d):
@@ -19,4 +20,11 @@ def mergeDicts(d0, d1):
         if k in d0:
             d0[k] += d1[k]
         else:
-            d0[k] = d1[k]
\ No newline at end of file
+            d0[k] = d1[k]
+def batch_tensors(raw_batch):
+    """ (s, a, r, s_prime, term) tensors of a training batch; a list of example tuples is stacked, a tuple of tensors is used as is """
+    if isinstance(raw_batch, tuple) and torch.is_tensor(raw_batch[0]):
+        return raw_batch
+    batch = [np.vstack(b) for b in zip(*raw_batch)]
+    return (torch.FloatTensor(batch[0]), torch.LongTensor(batch[1]), torch.FloatTensor(batch[2]),
+            torch.FloatTensor(batch[3]), torch.FloatTensor(np.array(batch[4]).astype(np.float32)))
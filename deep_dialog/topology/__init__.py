@@ -0,0 +1,6 @@
+from .cache import *
+from .centroids import *
+from .clustering import *
+from .embedding import *
+from .graph import *
+from .registry import *
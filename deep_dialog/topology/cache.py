@@ -0,0 +1,61 @@
+"""
+State-to-cluster cache
+
+Contextual representations are mostly one-hot bits plus a few KB counts, so
+the same vectors come back over and over across episodes. The cache maps a
+hash of the raw bytes of a representation to its cluster id and embedding row.
+"""
+
+from collections import OrderedDict
+
+
+class ClusterCache:
+    """ Bounded LRU cache: hash(contextual representation) -> (cluster id, embedding row) """
+
+    def __init__(self, capacity=50000):
+        self.capacity = capacity
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @staticmethod
+    def key(contextual_rep):
+        return hash(contextual_rep.tobytes())
+
+    def get(self, key):
+        """ Return the cached (cluster id, embedding row) or None """
+        
+        entry = self.entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return entry
+
+    def put(self, key, cluster_id, node_embedding):
+        if self.capacity <= 0:
+            return
+        self.entries[key] = (cluster_id, node_embedding)
+        self.entries.move_to_end(key)
+        if len(self.entries) > self.capacity:
+            self.entries.popitem(last=False)
+            self.evictions += 1
+
+    def clear(self):
+        self.entries.clear()
+
+    def empty_copy(self):
+        """ An empty cache with the same capacity and counters """
+        
+        cache = ClusterCache(self.capacity)
+        cache.hits, cache.misses, cache.evictions = self.hits, self.misses, self.evictions
+        return cache
+
+    def __len__(self):
+        return len(self.entries)
+
+    def stats(self):
+        return {'size': len(self.entries), 'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions,
+                'hit_rate': float(self.hits) / max(self.hits + self.misses, 1)}
@@ -0,0 +1,69 @@
+"""
+Nearest-centroid cluster assignment
+
+A batched replacement for KMeans.predict: squared distances to every
+centroid come from one float32 matrix product, and only the rows whose two
+closest centroids are too close to call in float32 are re-checked in float64
+with sklearn's own distance expression, so the labels match KMeans.predict
+(exact distance ties aside, which both sides resolve by rounding noise).
+"""
+
+import numpy as np
+
+
+class CentroidAssigner:
+    """ Assign contextual state representations to the closest k-means centroid """
+
+    # relative float32 distance gap below which a row is re-checked in float64
+    tie_tolerance = 1e-5
+
+    def __init__(self, centers):
+        self.refined_count = 0
+        self.set_centers(centers)
+
+    def set_centers(self, centers):
+        """ (Re)build the distance terms for a new set of centroids """
+        
+        self.centers64 = np.ascontiguousarray(centers, dtype=np.float64)
+        self.centers = self.centers64.astype(np.float32)
+        self.centers_t = np.ascontiguousarray(self.centers.T)
+        self.sq_norms64 = np.sum(self.centers64 ** 2, axis=1)
+        self.half_sq_norms = (0.5 * self.sq_norms64).astype(np.float32)
+        self.max_sq_norm = float(np.max(self.sq_norms64))
+
+    @classmethod
+    def from_kmeans(cls, kmeans):
+        return cls(kmeans.cluster_centers_)
+
+    @property
+    def n_clusters(self):
+        return self.centers.shape[0]
+
+    def assign(self, X):
+        """ Cluster ids (int64, shape (B,)) of a (B, D) or (D,) batch of contextual representations """
+        
+        X = np.asarray(X)
+        if X.ndim == 1:
+            X = X.reshape(1, -1)
+        X32 = X.astype(np.float32, copy=False)
+        
+        # argmin ||x - c||^2 == argmin (0.5 * ||c||^2 - x.c), ||x||^2 is shared by the row
+        scores = self.half_sq_norms - X32.dot(self.centers_t)
+        if self.n_clusters == 1:
+            return np.zeros(X.shape[0], dtype=np.int64)
+        
+        best2 = np.argpartition(scores, 1, axis=1)[:, :2]
+        rows = np.arange(X.shape[0])
+        first, second = scores[rows, best2[:, 0]], scores[rows, best2[:, 1]]
+        labels = np.where(first <= second, best2[:, 0], best2[:, 1]).astype(np.int64)
+        
+        # rows whose two closest centroids are within float32 noise of each other
+        scale = np.einsum('ij,ij->i', X32, X32) + self.max_sq_norm
+        ambiguous = np.nonzero(np.abs(first - second) <= self.tie_tolerance * scale)[0]
+        if len(ambiguous) > 0:
+            # same expression and tie-break (first minimum) as sklearn's dense Lloyd step
+            X64 = X[ambiguous].astype(np.float64)
+            d = self.sq_norms64 - 2 * X64.dot(self.centers64.T)
+            labels[ambiguous] = np.argmin(d, axis=1)
+            self.refined_count += len(ambiguous)
+        return labels
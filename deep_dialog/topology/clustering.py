@@ -0,0 +1,61 @@
+"""
+Streaming mini-batch k-means
+
+Moves the k-means centroids towards the states the current policy reaches,
+one replay mini-batch at a time (Sculley, 2010). Centroids are never
+re-ordered, re-seeded or dropped, so cluster ids keep indexing the same rows
+of the embedding table.
+"""
+
+import numpy as np
+
+from .centroids import CentroidAssigner
+
+
+class StreamingKMeans:
+    """ Mini-batch k-means over float32 centroids with a stable cluster-id mapping """
+
+    def __init__(self, centers, counts=None, init_count=100, max_count=10000):
+        """
+        Arguments:
+        centers         --  (k, D) initial centroids, copied
+        counts          --  per-centroid sample counts; init_count for every centroid when None
+        max_count       --  cap on the counts, so the step size never drops below 1 / max_count and centroids keep tracking drift
+        """
+        centers = np.array(centers, dtype=np.float32)
+        self.counts = np.full(len(centers), init_count, dtype=np.float64) if counts is None else np.array(counts, dtype=np.float64)
+        self.max_count = max_count
+        self.assigner = CentroidAssigner(centers)
+        self.n_updates = 0
+        self.n_samples = 0
+
+    @property
+    def centers(self):
+        return self.assigner.centers
+
+    @property
+    def n_clusters(self):
+        return self.assigner.n_clusters
+
+    def predict(self, X):
+        return self.assigner.assign(X)
+
+    def partial_fit(self, X):
+        """ One mini-batch step; returns the labels of X under the centroids before the step """
+        
+        X = np.asarray(X, dtype=np.float32)
+        labels = self.assigner.assign(X)
+        batch_counts = np.bincount(labels, minlength=self.n_clusters).astype(np.float64)
+        sums = np.zeros((self.n_clusters, X.shape[1]), dtype=np.float64)
+        np.add.at(sums, labels, X)
+        
+        # per-sample learning rate 1 / count, applied to the whole batch at once
+        hit = batch_counts > 0
+        centers = self.assigner.centers64.copy()
+        centers[hit] = (centers[hit] * self.counts[hit, None] + sums[hit]) / (self.counts[hit, None] + batch_counts[hit, None])
+        self.counts = np.minimum(self.counts + batch_counts, self.max_count)
+        self.assigner.set_centers(centers.astype(np.float32))
+        
+        self.n_updates += 1
+        self.n_samples += len(X)
+        return labels
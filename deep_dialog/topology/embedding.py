@@ -0,0 +1,178 @@
+"""
+Topological state features
+
+Keeps the k-means model and the GRL embedding table resident in memory so a
+state can be mapped to its cluster embedding without touching the disk.
+"""
+
+import time
+
+import numpy as np
+import pandas as pd
+import torch
+from joblib import load
+
+from .cache import ClusterCache
+from .centroids import CentroidAssigner
+from .clustering import StreamingKMeans
+
+
+def load_embedding_table(path):
+    """ Load a node embedding table (.csv from node2vec, .pt/.pth from GraphSAGE) as a float32 matrix indexed by cluster id """
+    
+    if path.endswith('.csv'):
+        embeddings_df = pd.read_csv(path)
+        # the first unnamed column holds the node (cluster) id, rows are not sorted
+        ids = embeddings_df.iloc[:, 0].values.astype(int)
+        values = embeddings_df.iloc[:, 1:].values.astype(np.float32)
+        embeddings = np.zeros((ids.max() + 1, values.shape[1]), dtype=np.float32)
+        embeddings[ids] = values
+    else:
+        embeddings_tensor = torch.load(path, map_location='cpu')
+        embeddings = embeddings_tensor.detach().cpu().numpy().astype(np.float32)
+    return embeddings
+
+
+class TopologyArtifact:
+    """ k-means centroids and the embedding table of their cluster graph, loaded once and shared read-only """
+
+    def __init__(self, centers, embeddings, kmeans_path=None, embedding_path=None, load_time=0.):
+        self.centers = centers
+        self.assigner = CentroidAssigner(centers)
+        self.embeddings = embeddings
+        if self.embeddings.flags.writeable:
+            self.embeddings.setflags(write=False)
+        self.kmeans_path = kmeans_path
+        self.embedding_path = embedding_path
+        self.load_time = load_time
+
+    @classmethod
+    def from_files(cls, kmeans_path, embedding_path):
+        """ From a k-means .joblib and a GRL embedding table (.pt/.csv) """
+        
+        start = time.time()
+        centers = load(kmeans_path).cluster_centers_
+        embeddings = load_embedding_table(embedding_path)
+        return cls(centers, embeddings, kmeans_path, embedding_path, time.time() - start)
+
+    @classmethod
+    def from_store(cls, path):
+        """ Memory-mapped from a .topo file """
+        
+        from .store import load_topology
+        start = time.time()
+        arrays, meta = load_topology(path)
+        return cls(arrays['centroids'], arrays['embeddings'], path, path, time.time() - start)
+
+    def __deepcopy__(self, memo):
+        # read-only, shared by every agent (and agent snapshot) of the process
+        return self
+
+    @property
+    def n_clusters(self):
+        return self.centers.shape[0]
+
+    @property
+    def contextual_dim(self):
+        return self.centers.shape[1]
+
+    @property
+    def embedding_dim(self):
+        return self.embeddings.shape[1]
+
+    def validate(self, contextual_dim):
+        """ Check the artifact against the contextual state size of an agent """
+        
+        if self.contextual_dim != contextual_dim:
+            raise Exception('topology: %s expects %d contextual features, the agent state has %d' % (self.kmeans_path, self.contextual_dim, contextual_dim))
+        if self.embeddings.shape[0] < self.n_clusters:
+            raise Exception('topology: %s has %d rows for %d clusters' % (self.embedding_path, self.embeddings.shape[0], self.n_clusters))
+
+
+class TopologyEmbedding:
+    """ Resident embedding service: cluster a contextual state representation and return its topology vector """
+
+    def __init__(self, artifact, cache_size=50000):
+        self.artifact = artifact
+        self.embeddings = artifact.embeddings
+        # assigner and cache are replaced together by update_clusters (possibly from a learner thread):
+        # lookups read both from one reference, so they never mix centroids or cached ids of two generations
+        self.current = (artifact.assigner, ClusterCache(cache_size))
+        self.streaming = None
+        
+        self.lookup_count = 0
+        self.lookup_time = 0.
+
+    @property
+    def embedding_dim(self):
+        return self.embeddings.shape[1]
+
+    @property
+    def assigner(self):
+        return self.current[0]
+
+    @property
+    def cache(self):
+        return self.current[1]
+
+    def cluster(self, contextual_rep):
+        """ Return the cluster index of a single contextual representation """
+        return self.lookup_cluster(contextual_rep)[0]
+
+    def lookup(self, contextual_rep):
+        """ Return the topology embedding of a single contextual representation """
+        return self.lookup_cluster(contextual_rep)[1]
+
+    def lookup_cluster(self, contextual_rep):
+        """ Cluster id and topology embedding of a single contextual representation, served from the cache when seen before """
+        
+        start = time.time()
+        assigner, cache = self.current
+        key = cache.key(contextual_rep)
+        entry = cache.get(key)
+        if entry is None:
+            cluster_id = int(assigner.assign(contextual_rep)[0])
+            entry = (cluster_id, self.embeddings[cluster_id])
+            cache.put(key, *entry)
+        self.lookup_time += time.time() - start
+        self.lookup_count += 1
+        return entry
+
+    def lookup_batch(self, contextual_reps):
+        """ Cluster ids (B,) and topology embeddings (B, d) of a (B, D) batch of contextual representations """
+        
+        start = time.time()
+        assigner, cache = self.current
+        keys = [cache.key(rep) for rep in contextual_reps]
+        cluster_ids = np.empty(len(keys), dtype=np.int64)
+        missing = []
+        for i, key in enumerate(keys):
+            entry = cache.get(key)
+            if entry is None:
+                missing.append(i)
+            else:
+                cluster_ids[i] = entry[0]
+        if len(missing) > 0:
+            cluster_ids[missing] = assigner.assign(contextual_reps[missing])
+            for i in missing:
+                cache.put(keys[i], int(cluster_ids[i]), self.embeddings[cluster_ids[i]])
+        node_embeddings = self.embeddings[cluster_ids]
+        self.lookup_time += time.time() - start
+        self.lookup_count += len(keys)
+        return cluster_ids, node_embeddings
+
+    def update_clusters(self, contextual_reps):
+        """ Move this agent's centroids towards a batch of visited states (streaming k-means step) """
+        
+        if self.streaming is None:
+            # copy-on-write: the artifact's centroids stay shared and untouched
+            self.streaming = StreamingKMeans(self.assigner.centers)
+        self.streaming.partial_fit(contextual_reps)
+        # lookups get a snapshot of the new centroids, and an empty cache since cached ids were computed against the old ones
+        self.current = (CentroidAssigner(self.streaming.centers), self.cache.empty_copy())
+
+    def stats(self):
+        """ Load time (s) and mean lookup latency (ms) """
+        return {'load_time': self.artifact.load_time, 'lookups': self.lookup_count,
+                'ave_lookup_ms': 1000. * self.lookup_time / max(self.lookup_count, 1), 'cache': self.cache.stats(),
+                'cluster_updates': self.streaming.n_updates if self.streaming is not None else 0}
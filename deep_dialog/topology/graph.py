@@ -0,0 +1,151 @@
+"""
+Transition graph over state clusters
+
+Edges (cluster(s_t), a_t, cluster(s_t+1)) are recorded online while dialogs
+run. New transitions go to an append buffer that is periodically merged into
+a compressed sparse row (CSR) adjacency holding, per (src, action, dst) edge,
+the number of times it was taken and the sum of the rewards received.
+"""
+
+import ast
+import os
+import time
+
+import numpy as np
+
+
+class TransitionGraph:
+    """ Growable CSR transition graph between state clusters, with edge counts and rewards """
+
+    def __init__(self, n_nodes=0, n_actions=0, buffer_size=4096, snapshot_path=None, snapshot_every=0):
+        self.n_nodes = n_nodes
+        self.n_actions = n_actions
+        
+        # CSR over source nodes, edges sorted by (src, dst, action)
+        self.indptr = np.zeros(n_nodes + 1, dtype=np.int64)
+        self.indices = np.zeros(0, dtype=np.int32)
+        self.actions = np.zeros(0, dtype=np.int32)
+        self.counts = np.zeros(0, dtype=np.int64)
+        self.rewards = np.zeros(0, dtype=np.float64)
+        
+        # transitions not merged into the CSR arrays yet
+        self.buffer_size = buffer_size
+        self.pending = np.zeros((buffer_size, 3), dtype=np.int32)
+        self.pending_rewards = np.zeros(buffer_size, dtype=np.float64)
+        self.n_pending = 0
+        
+        self.n_transitions = 0
+        self.snapshot_path = snapshot_path
+        self.snapshot_every = snapshot_every
+        self.last_snapshot = 0
+
+    def add(self, src, action, dst, reward):
+        """ Record one transition src --action--> dst """
+        
+        self.pending[self.n_pending] = (src, action, dst)
+        self.pending_rewards[self.n_pending] = reward
+        self.n_pending += 1
+        self.n_transitions += 1
+        if self.n_pending == self.buffer_size:
+            self.compact()
+        if self.snapshot_path and self.snapshot_every > 0 and self.n_transitions - self.last_snapshot >= self.snapshot_every:
+            self.save(self.snapshot_path)
+
+    def compact(self):
+        """ Merge the pending transitions into the CSR arrays """
+        
+        if self.n_pending == 0:
+            return
+        pending = self.pending[:self.n_pending]
+        self.n_nodes = max(self.n_nodes, int(pending[:, [0, 2]].max()) + 1)
+        self.n_actions = max(self.n_actions, int(pending[:, 1].max()) + 1)
+        
+        src = np.concatenate([np.repeat(np.arange(len(self.indptr) - 1, dtype=np.int64), np.diff(self.indptr)), pending[:, 0]])
+        dst = np.concatenate([self.indices, pending[:, 2]]).astype(np.int64)
+        act = np.concatenate([self.actions, pending[:, 1]]).astype(np.int64)
+        counts = np.concatenate([self.counts, np.ones(self.n_pending, dtype=np.int64)])
+        rewards = np.concatenate([self.rewards, self.pending_rewards[:self.n_pending]])
+        
+        key = (src * self.n_nodes + dst) * self.n_actions + act
+        unique_key, inverse = np.unique(key, return_inverse=True)
+        self.counts = np.bincount(inverse, weights=counts, minlength=len(unique_key)).astype(np.int64)
+        self.rewards = np.bincount(inverse, weights=rewards, minlength=len(unique_key))
+        self.actions = (unique_key % self.n_actions).astype(np.int32)
+        self.indices = ((unique_key // self.n_actions) % self.n_nodes).astype(np.int32)
+        edge_src = unique_key // (self.n_actions * self.n_nodes)
+        self.indptr = np.concatenate([[0], np.cumsum(np.bincount(edge_src, minlength=self.n_nodes))]).astype(np.int64)
+        self.n_pending = 0
+
+    @property
+    def n_edges(self):
+        self.compact()
+        return len(self.indices)
+
+    def adjacency(self):
+        """ CSR (indptr, indices, weights) of the cluster graph with actions collapsed; weights are transition counts """
+        
+        self.compact()
+        src = np.repeat(np.arange(self.n_nodes, dtype=np.int64), np.diff(self.indptr))
+        key = src * self.n_nodes + self.indices
+        unique_key, inverse = np.unique(key, return_inverse=True)
+        weights = np.bincount(inverse, weights=self.counts).astype(np.int64)
+        indptr = np.concatenate([[0], np.cumsum(np.bincount(unique_key // self.n_nodes, minlength=self.n_nodes))]).astype(np.int64)
+        return indptr, (unique_key % self.n_nodes).astype(np.int32), weights
+
+    def save(self, path):
+        """ Snapshot the graph to a .npz file (written to a temporary file first, then renamed) """
+        
+        self.compact()
+        tmp_path = path + '.tmp.npz'
+        np.savez(tmp_path, indptr=self.indptr, indices=self.indices, actions=self.actions, counts=self.counts,
+                 rewards=self.rewards, n_nodes=self.n_nodes, n_actions=self.n_actions, n_transitions=self.n_transitions,
+                 timestamp=time.time())
+        os.replace(tmp_path, path)
+        self.last_snapshot = self.n_transitions
+
+    @classmethod
+    def load(cls, path, **kwargs):
+        data = np.load(path)
+        graph = cls(int(data['n_nodes']), int(data['n_actions']), **kwargs)
+        graph.indptr = data['indptr']
+        graph.indices = data['indices']
+        graph.actions = data['actions']
+        graph.counts = data['counts']
+        graph.rewards = data['rewards']
+        graph.n_transitions = int(data['n_transitions'])
+        graph.last_snapshot = graph.n_transitions
+        return graph
+
+    @classmethod
+    def from_edgelist(cls, path, **kwargs):
+        """ Read a networkx edgelist ("src dst {'weight': w}" lines); the actions are unknown and recorded as 0 """
+        
+        edges = []
+        with open(path, 'r') as f:
+            for line in f:
+                parts = line.split(None, 2)
+                if len(parts) < 2:
+                    continue
+                data = ast.literal_eval(parts[2]) if len(parts) > 2 else {}
+                edges.append((int(parts[0]), int(parts[1]), int(data.get('weight', 1))))
+        edges = np.array(edges, dtype=np.int64).reshape(-1, 3)
+        graph = cls(int(edges[:, :2].max()) + 1 if len(edges) > 0 else 0, 1, **kwargs)
+        if len(edges) > 0:
+            order = np.lexsort((edges[:, 1], edges[:, 0]))
+            edges = edges[order]
+            graph.indices = edges[:, 1].astype(np.int32)
+            graph.actions = np.zeros(len(edges), dtype=np.int32)
+            graph.counts = edges[:, 2]
+            graph.rewards = np.zeros(len(edges), dtype=np.float64)
+            graph.indptr = np.concatenate([[0], np.cumsum(np.bincount(edges[:, 0], minlength=graph.n_nodes))]).astype(np.int64)
+            graph.n_transitions = int(edges[:, 2].sum())
+        return graph
+
+    def save_edgelist(self, path):
+        """ Write the collapsed graph in the networkx edgelist layout of movie40transition_graph.edgelist """
+        
+        indptr, indices, weights = self.adjacency()
+        with open(path, 'w') as f:
+            for src in range(self.n_nodes):
+                for e in range(indptr[src], indptr[src + 1]):
+                    f.write("%d %d {'weight': %d}\n" % (src, indices[e], weights[e]))
@@ -0,0 +1,233 @@
+"""
+GraphSAGE over the cluster transition graph
+
+Trains node embeddings with the adjacency-reconstruction objective (an edge
+src -> dst should score high under z_src . z_dst, random pairs low) on CPU,
+with sparse mean aggregation and mini-batch neighbor sampling. Parameter names
+follow the movie40graphsage-*_model_adj_recon.pth checkpoints, and the
+embedding table is saved as the (n_nodes, dim) float tensor that
+TopologyEmbedding reads.
+
+Command: python -m deep_dialog.topology.graphsage --graph movie40transition_graph.edgelist --kmeans_path kmeans_modelMovie_k40.joblib --dim 32 --out_prefix movie40graphsage-n32
+"""
+
+import argparse, json, time
+
+import numpy as np
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+from joblib import load
+
+from .graph import TransitionGraph
+
+
+class SAGEConv(nn.Module):
+    """ Mean-aggregator GraphSAGE layer: lin_l(mean of in-neighbors) + lin_r(self) """
+
+    def __init__(self, in_channels, out_channels):
+        super(SAGEConv, self).__init__()
+        self.lin_l = nn.Linear(in_channels, out_channels)
+        self.lin_r = nn.Linear(in_channels, out_channels, bias=False)
+
+    def forward(self, x_source, x_target, mean_adj):
+        """ mean_adj: sparse (n_target, n_source) row-normalized adjacency """
+        return self.lin_l(torch.sparse.mm(mean_adj, x_source)) + self.lin_r(x_target)
+
+
+class GraphSAGE(nn.Module):
+    def __init__(self, in_channels, hidden_channels=300, out_channels=32):
+        super(GraphSAGE, self).__init__()
+        self.conv1 = SAGEConv(in_channels, hidden_channels)
+        self.conv2 = SAGEConv(hidden_channels, out_channels)
+        # present in the shipped checkpoints but never trained there; kept so they load strictly
+        self.bn3 = nn.BatchNorm1d(out_channels)
+
+    def forward(self, x, blocks):
+        """ blocks: [(n_target, mean_adj)] from the input layer up; the targets of a block are the first rows of its sources """
+        
+        h = x
+        for i, (n_target, mean_adj) in enumerate(blocks):
+            conv = self.conv1 if i == 0 else self.conv2
+            h = conv(h, h[:n_target], mean_adj)
+            if i == 0:
+                h = F.relu(h)
+        return h
+
+
+def reverse_csr(indptr, indices, n_nodes):
+    """ CSR of in-neighbors from the CSR of out-neighbors """
+    
+    src = np.repeat(np.arange(n_nodes, dtype=np.int64), np.diff(indptr))
+    order = np.argsort(indices, kind='stable')
+    in_indptr = np.concatenate([[0], np.cumsum(np.bincount(indices, minlength=n_nodes))]).astype(np.int64)
+    return in_indptr, src[order]
+
+
+def mean_adjacency(rows, cols, n_rows, n_cols):
+    """ Sparse row-normalized adjacency with ones at (rows, cols) """
+    
+    deg = np.bincount(rows, minlength=n_rows).astype(np.float32)
+    values = 1. / deg[rows]
+    index = torch.from_numpy(np.vstack([rows, cols]).astype(np.int64))
+    return torch.sparse_coo_tensor(index, torch.from_numpy(values), (n_rows, n_cols)).coalesce()
+
+
+class NeighborSampler:
+    """ Samples up to fanout in-neighbors per node and layer, building the blocks GraphSAGE.forward consumes """
+
+    def __init__(self, indptr, indices, n_nodes, fanouts, rng=None):
+        self.in_indptr, self.in_indices = reverse_csr(indptr, indices, n_nodes)
+        self.n_nodes = n_nodes
+        self.fanouts = fanouts
+        self.rng = rng or np.random.RandomState()
+        self.position = np.full(n_nodes, -1, dtype=np.int64)
+
+    def sample_neighbors(self, nodes, fanout):
+        """ (local target index, neighbor node) pairs; nodes with more than fanout in-neighbors are sampled with replacement """
+        
+        start = self.in_indptr[nodes]
+        deg = self.in_indptr[nodes + 1] - start
+        take = np.minimum(deg, fanout)
+        rows = np.repeat(np.arange(len(nodes)), take)
+        # offset of each pair within its node's neighbor list
+        offsets = np.arange(take.sum()) - np.repeat(np.cumsum(take) - take, take)
+        sampled = deg[rows] > fanout
+        offsets[sampled] = (self.rng.random_sample(sampled.sum()) * deg[rows][sampled]).astype(np.int64)
+        return rows, self.in_indices[start[rows] + offsets]
+
+    def sample(self, nodes):
+        """ Return (input nodes, blocks) for the output nodes """
+        
+        nodes = np.asarray(nodes, dtype=np.int64)
+        blocks = []
+        for fanout in reversed(self.fanouts):
+            rows, neighbors = self.sample_neighbors(nodes, fanout)
+            self.position[nodes] = np.arange(len(nodes))
+            extra = np.setdiff1d(np.unique(neighbors), nodes)
+            self.position[extra] = len(nodes) + np.arange(len(extra))
+            sources = np.concatenate([nodes, extra])
+            cols = self.position[neighbors]
+            self.position[sources] = -1
+            blocks.insert(0, (len(nodes), mean_adjacency(rows, cols, len(nodes), len(sources))))
+            nodes = sources
+        return nodes, blocks
+
+    def full_blocks(self, n_layers):
+        """ Blocks over the whole graph with every in-neighbor (inference) """
+        
+        rows = np.repeat(np.arange(self.n_nodes, dtype=np.int64), np.diff(self.in_indptr))
+        mean_adj = mean_adjacency(rows, self.in_indices, self.n_nodes, self.n_nodes)
+        return [(self.n_nodes, mean_adj)] * n_layers
+
+
+class GraphSAGETrainer:
+    """ Adjacency-reconstruction training of GraphSAGE on a TransitionGraph """
+
+    def __init__(self, graph, features, hidden_size=300, embedding_dim=32, fanouts=(10, 10), lr=0.01, num_threads=0, seed=0):
+        if num_threads > 0:
+            torch.set_num_threads(num_threads)
+        torch.manual_seed(seed)
+        self.rng = np.random.RandomState(seed)
+        
+        self.indptr, self.indices, _ = graph.adjacency()
+        self.n_nodes = graph.n_nodes
+        self.edge_src = np.repeat(np.arange(self.n_nodes, dtype=np.int64), np.diff(self.indptr))
+        self.edge_dst = self.indices.astype(np.int64)
+        self.features = torch.from_numpy(np.asarray(features, dtype=np.float32)[:self.n_nodes])
+        
+        self.sampler = NeighborSampler(self.indptr, self.indices, self.n_nodes, list(fanouts), self.rng)
+        self.model = GraphSAGE(self.features.shape[1], hidden_size, embedding_dim)
+        self.optimizer = torch.optim.Adam(self.model.parameters(), lr=lr)
+
+    def step(self, batch_size, negative_ratio=1):
+        """ One gradient step on a batch of edges and as many random non-edges per edge """
+        
+        e = self.rng.randint(0, len(self.edge_src), batch_size)
+        src = np.concatenate([self.edge_src[e], np.repeat(self.edge_src[e], negative_ratio)])
+        dst = np.concatenate([self.edge_dst[e], self.rng.randint(0, self.n_nodes, batch_size * negative_ratio)])
+        labels = torch.cat([torch.ones(batch_size), torch.zeros(batch_size * negative_ratio)])
+        
+        nodes, inverse = np.unique(np.concatenate([src, dst]), return_inverse=True)
+        input_nodes, blocks = self.sampler.sample(nodes)
+        z = self.model(self.features[input_nodes], blocks)
+        z_src, z_dst = z[inverse[:len(src)]], z[inverse[len(src):]]
+        loss = F.binary_cross_entropy_with_logits((z_src * z_dst).sum(-1), labels)
+        
+        self.optimizer.zero_grad()
+        loss.backward()
+        self.optimizer.step()
+        return loss.item()
+
+    def train(self, epochs=200, batch_size=512, negative_ratio=1, verbose=True):
+        steps_per_epoch = max(1, len(self.edge_src) // batch_size)
+        for epoch in range(epochs):
+            start = time.time()
+            loss = 0.
+            for _ in range(steps_per_epoch):
+                loss += self.step(batch_size, negative_ratio)
+            if verbose and (epoch % 10 == 0 or epoch == epochs - 1):
+                print(("graphsage epoch %d, loss %.4f, %.3fs/epoch" % (epoch, loss / steps_per_epoch, time.time() - start)))
+        return loss / steps_per_epoch
+
+    def embeddings(self):
+        """ (n_nodes, dim) embeddings with full neighborhoods """
+        
+        self.model.eval()
+        with torch.no_grad():
+            z = self.model(self.features, self.sampler.full_blocks(2))
+        self.model.train()
+        return z
+
+    def save(self, out_prefix):
+        """ Write <out_prefix>_model_adj_recon.pth and <out_prefix>_node_embeddings_adj_recon.pt """
+        
+        torch.save(self.model.state_dict(), out_prefix + '_model_adj_recon.pth')
+        torch.save(self.embeddings(), out_prefix + '_node_embeddings_adj_recon.pt')
+        print(('saved GraphSAGE model and embeddings in %s_*' % (out_prefix, )))
+
+
+def load_graph(path):
+    """ A TransitionGraph from a .npz snapshot or a networkx .edgelist """
+    
+    if path.endswith('.npz'):
+        return TransitionGraph.load(path)
+    return TransitionGraph.from_edgelist(path)
+
+
+def main(params):
+    graph = load_graph(params['graph'])
+    if params['features'] != None:
+        features = np.load(params['features'])
+    else:
+        features = load(params['kmeans_path']).cluster_centers_
+    trainer = GraphSAGETrainer(graph, features, params['hidden_size'], params['dim'], params['fanouts'],
+                               params['lr'], params['num_threads'], params['seed'])
+    trainer.train(params['epochs'], params['batch_size'], params['negative_ratio'])
+    trainer.save(params['out_prefix'])
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument('--graph', dest='graph', type=str, default='movie40transition_graph.edgelist', help='transition graph (.npz snapshot or .edgelist)')
+    parser.add_argument('--kmeans_path', dest='kmeans_path', type=str, default='kmeans_modelMovie_k40.joblib', help='k-means model; its centroids are the node features')
+    parser.add_argument('--features', dest='features', type=str, default=None, help='.npy node features, instead of the k-means centroids')
+    parser.add_argument('--hidden_size', dest='hidden_size', type=int, default=300)
+    parser.add_argument('--dim', dest='dim', type=int, default=32, help='embedding dimension')
+    parser.add_argument('--fanouts', dest='fanouts', type=int, nargs='+', default=[10, 10], help='sampled in-neighbors per layer (input layer first)')
+    parser.add_argument('--epochs', dest='epochs', type=int, default=200)
+    parser.add_argument('--batch_size', dest='batch_size', type=int, default=512, help='edges per step')
+    parser.add_argument('--negative_ratio', dest='negative_ratio', type=int, default=1, help='random non-edges per edge')
+    parser.add_argument('--lr', dest='lr', type=float, default=0.01)
+    parser.add_argument('--num_threads', dest='num_threads', type=int, default=0, help='torch CPU threads; 0 keeps the default')
+    parser.add_argument('--seed', dest='seed', type=int, default=0)
+    parser.add_argument('--out_prefix', dest='out_prefix', type=str, default='movie40graphsage-n32')
+
+    args = parser.parse_args()
+    params = vars(args)
+
+    print ("GraphSAGE Parameters:")
+    print((json.dumps(params, indent=2)))
+
+    main(params)
@@ -0,0 +1,242 @@
+"""
+Node2Vec over the cluster transition graph
+
+Second-order transition probabilities (return parameter p, in-out parameter q)
+are precomputed as one alias table per edge, so every walk step is two uniform
+draws and two array lookups; all walks advance together as NumPy arrays.
+Skip-gram embeddings are then trained with negative sampling on CPU and
+written in the layouts TopologyEmbedding reads: a .csv whose first unnamed
+column is the node id (like movie40-32n_node2vec_embeddings.csv) and a
+(n_nodes, dim) float tensor .pt.
+
+Command: python -m deep_dialog.topology.node2vec --graph movie40transition_graph.edgelist --dim 32 --out_prefix movie40-32n
+"""
+
+import argparse, json, time
+
+import numpy as np
+import pandas as pd
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+from .graphsage import load_graph
+
+
+def alias_setup(probs):
+    """ Vose alias table of a normalized distribution: (prob, alias) """
+    
+    n = len(probs)
+    prob = np.zeros(n, dtype=np.float64)
+    alias = np.zeros(n, dtype=np.int64)
+    scaled = probs * n
+    small = [i for i in range(n) if scaled[i] < 1.]
+    large = [i for i in range(n) if scaled[i] >= 1.]
+    while small and large:
+        s, l = small.pop(), large.pop()
+        prob[s] = scaled[s]
+        alias[s] = l
+        scaled[l] = scaled[l] + scaled[s] - 1.
+        if scaled[l] < 1.:
+            small.append(l)
+        else:
+            large.append(l)
+    for i in small + large:
+        prob[i] = 1.
+        alias[i] = i
+    return prob, alias
+
+
+class Node2VecWalker:
+    """ Batched biased random walks from precomputed first- and second-order alias tables """
+
+    def __init__(self, indptr, indices, weights, n_nodes, p=1., q=1., rng=None):
+        self.indptr = np.asarray(indptr, dtype=np.int64)
+        self.indices = np.asarray(indices, dtype=np.int64)
+        self.weights = np.asarray(weights, dtype=np.float64)
+        self.n_nodes = n_nodes
+        self.p = p
+        self.q = q
+        self.rng = rng or np.random.RandomState()
+        self.degree = np.diff(self.indptr)
+        
+        start = time.time()
+        self.node_prob, self.node_alias = self.build_tables(self.indptr, self.weights)
+        self.edge_offsets, self.edge_prob, self.edge_alias = self.build_edge_tables()
+        self.setup_time = time.time() - start
+
+    def build_tables(self, offsets, weights):
+        """ Concatenated alias tables of the segments weights[offsets[i]:offsets[i+1]] """
+        
+        prob = np.ones(len(weights), dtype=np.float64)
+        alias = np.zeros(len(weights), dtype=np.int64)
+        for i in range(len(offsets) - 1):
+            a, b = offsets[i], offsets[i + 1]
+            if b > a:
+                prob[a:b], alias[a:b] = alias_setup(weights[a:b] / weights[a:b].sum())
+        return prob, alias
+
+    def build_edge_tables(self):
+        """ For each edge t -> v, the distribution over v's out-neighbors x: w(v, x) / p if x == t, w(v, x) if t -> x, w(v, x) / q otherwise """
+        
+        edge_src = np.repeat(np.arange(self.n_nodes, dtype=np.int64), self.degree)
+        edge_dst = self.indices
+        table_size = self.degree[edge_dst]
+        edge_offsets = np.concatenate([[0], np.cumsum(table_size)]).astype(np.int64)
+        
+        # every (edge t -> v, candidate edge v -> x) pair
+        pair_edge = np.repeat(np.arange(len(edge_dst)), table_size)
+        pair_next = self.indptr[edge_dst[pair_edge]] + np.arange(edge_offsets[-1]) - edge_offsets[pair_edge]
+        t, x = edge_src[pair_edge], self.indices[pair_next]
+        
+        # t -> x membership through the sorted (src, dst) keys of the CSR
+        edge_keys = edge_src * self.n_nodes + edge_dst
+        pos = np.minimum(np.searchsorted(edge_keys, t * self.n_nodes + x), len(edge_keys) - 1)
+        linked = edge_keys[pos] == t * self.n_nodes + x
+        
+        bias = np.where(x == t, 1. / self.p, np.where(linked, 1., 1. / self.q))
+        prob, alias = self.build_tables(edge_offsets, self.weights[pair_next] * bias)
+        return edge_offsets, prob, alias
+
+    def draw(self, offsets, sizes, prob, alias):
+        """ One alias draw per row from the tables starting at offsets """
+        
+        k = (self.rng.random_sample(len(offsets)) * sizes).astype(np.int64)
+        keep = self.rng.random_sample(len(offsets)) < prob[offsets + k]
+        return np.where(keep, k, alias[offsets + k])
+
+    def walks(self, num_walks, walk_length):
+        """ (num_walks * n_nodes, walk_length) walks; -1 pads walks that reached a node without out-edges """
+        
+        starts = np.tile(np.arange(self.n_nodes, dtype=np.int64), num_walks)
+        walks = np.full((len(starts), walk_length), -1, dtype=np.int64)
+        walks[:, 0] = starts
+        
+        active = np.nonzero(self.degree[starts] > 0)[0]
+        node = starts[active]
+        j = self.draw(self.indptr[node], self.degree[node], self.node_prob, self.node_alias)
+        edge = self.indptr[node] + j
+        for step in range(1, walk_length):
+            walks[active, step] = self.indices[edge]
+            if step == walk_length - 1:
+                break
+            node = self.indices[edge]
+            alive = self.degree[node] > 0
+            active, edge = active[alive], edge[alive]
+            j = self.draw(self.edge_offsets[edge], self.degree[self.indices[edge]], self.edge_prob, self.edge_alias)
+            edge = self.indptr[self.indices[edge]] + j
+        return walks
+
+
+class SkipGram(nn.Module):
+    def __init__(self, n_nodes, dim):
+        super(SkipGram, self).__init__()
+        self.input_emb = nn.Embedding(n_nodes, dim, sparse=True)
+        self.output_emb = nn.Embedding(n_nodes, dim, sparse=True)
+        nn.init.uniform_(self.input_emb.weight, -0.5 / dim, 0.5 / dim)
+        nn.init.zeros_(self.output_emb.weight)
+
+    def forward(self, center, context, negatives):
+        u = self.input_emb(center)
+        pos = (u * self.output_emb(context)).sum(-1)
+        neg = torch.bmm(self.output_emb(negatives), u.unsqueeze(-1)).squeeze(-1)
+        return -(F.logsigmoid(pos) + F.logsigmoid(-neg).sum(-1)).mean()
+
+
+def skipgram_pairs(walks, window):
+    """ (center, context) pairs of every node within window steps of each other """
+    
+    centers, contexts = [], []
+    for offset in range(1, window + 1):
+        a, b = walks[:, :-offset].ravel(), walks[:, offset:].ravel()
+        valid = (a >= 0) & (b >= 0)
+        centers.extend([a[valid], b[valid]])
+        contexts.extend([b[valid], a[valid]])
+    return np.concatenate(centers), np.concatenate(contexts)
+
+
+class Node2Vec:
+    """ Walks + skip-gram with negative sampling """
+
+    def __init__(self, graph, dim=32, p=1., q=1., num_threads=0, seed=0):
+        if num_threads > 0:
+            torch.set_num_threads(num_threads)
+        torch.manual_seed(seed)
+        self.rng = np.random.RandomState(seed)
+        indptr, indices, weights = graph.adjacency()
+        self.n_nodes = graph.n_nodes
+        self.walker = Node2VecWalker(indptr, indices, weights, self.n_nodes, p, q, self.rng)
+        self.model = SkipGram(self.n_nodes, dim)
+
+    def train(self, num_walks=10, walk_length=80, window=10, negative=5, epochs=1, batch_size=4096, lr=0.01, verbose=True):
+        start = time.time()
+        walks = self.walker.walks(num_walks, walk_length)
+        centers, contexts = skipgram_pairs(walks, window)
+        if verbose:
+            print(("node2vec: %d walks, %d pairs in %.2fs (alias setup %.2fs)" % (len(walks), len(centers), time.time() - start, self.walker.setup_time)))
+        
+        # unigram^0.75 noise distribution
+        freq = np.bincount(walks[walks >= 0], minlength=self.n_nodes).astype(np.float64) ** 0.75
+        noise = torch.from_numpy(freq / freq.sum())
+        optimizer = torch.optim.SparseAdam(list(self.model.parameters()), lr=lr)
+        
+        for epoch in range(epochs):
+            order = self.rng.permutation(len(centers))
+            loss = 0.
+            for b in range(0, len(order), batch_size):
+                idx = order[b:b + batch_size]
+                center = torch.from_numpy(centers[idx])
+                negatives = torch.multinomial(noise, len(idx) * negative, replacement=True).view(len(idx), negative)
+                batch_loss = self.model(center, torch.from_numpy(contexts[idx]), negatives)
+                optimizer.zero_grad()
+                batch_loss.backward()
+                optimizer.step()
+                loss += batch_loss.item() * len(idx)
+            if verbose:
+                print(("node2vec epoch %d, loss %.4f, %.2fs" % (epoch, loss / max(len(order), 1), time.time() - start)))
+
+    def embeddings(self):
+        return self.model.input_emb.weight.detach().clone()
+
+    def save(self, out_prefix):
+        """ Write <out_prefix>_node2vec_embeddings.csv and <out_prefix>_node2vec_embeddings.pt """
+        
+        embeddings = self.embeddings()
+        pd.DataFrame(embeddings.numpy()).to_csv(out_prefix + '_node2vec_embeddings.csv')
+        torch.save(embeddings, out_prefix + '_node2vec_embeddings.pt')
+        print(('saved node2vec embeddings in %s_node2vec_embeddings.csv/.pt' % (out_prefix, )))
+
+
+def main(params):
+    graph = load_graph(params['graph'])
+    node2vec = Node2Vec(graph, params['dim'], params['p'], params['q'], params['num_threads'], params['seed'])
+    node2vec.train(params['num_walks'], params['walk_length'], params['window'], params['negative'],
+                   params['epochs'], params['batch_size'], params['lr'])
+    node2vec.save(params['out_prefix'])
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument('--graph', dest='graph', type=str, default='movie40transition_graph.edgelist', help='transition graph (.npz snapshot or .edgelist)')
+    parser.add_argument('--dim', dest='dim', type=int, default=32, help='embedding dimension')
+    parser.add_argument('--p', dest='p', type=float, default=1., help='return parameter')
+    parser.add_argument('--q', dest='q', type=float, default=1., help='in-out parameter')
+    parser.add_argument('--num_walks', dest='num_walks', type=int, default=200, help='walks per node')
+    parser.add_argument('--walk_length', dest='walk_length', type=int, default=30)
+    parser.add_argument('--window', dest='window', type=int, default=10)
+    parser.add_argument('--negative', dest='negative', type=int, default=5, help='negative samples per pair')
+    parser.add_argument('--epochs', dest='epochs', type=int, default=1)
+    parser.add_argument('--batch_size', dest='batch_size', type=int, default=4096)
+    parser.add_argument('--lr', dest='lr', type=float, default=0.01)
+    parser.add_argument('--num_threads', dest='num_threads', type=int, default=0, help='torch CPU threads; 0 keeps the default')
+    parser.add_argument('--seed', dest='seed', type=int, default=0)
+    parser.add_argument('--out_prefix', dest='out_prefix', type=str, default='movie40-32n')
+
+    args = parser.parse_args()
+    params = vars(args)
+
+    print ("Node2Vec Parameters:")
+    print((json.dumps(params, indent=2)))
+
+    main(params)
@@ -0,0 +1,67 @@
+"""
+Topology artifact registry
+
+Maps a domain and an embedding variant to the k-means model and the node
+embedding table produced for it, and keeps one loaded copy per process.
+"""
+
+import os
+
+from .embedding import TopologyArtifact
+
+
+# agent id (run.py --agt) -> domain
+topology_domains = {9: 'movie', 12: 'restaurant', 13: 'taxi'}
+
+# embedding variant -> file name pattern, filled with (domain, k)
+embedding_variants = {
+    'graphsage-n8': '%s%dgraphsage-n8_node_embeddings_adj_recon.pt',
+    'graphsage-n16': '%s%dgraphsage-n16_node_embeddings_adj_recon.pt',
+    'graphsage-n32': '%s%dgraphsage-n32_node_embeddings_adj_recon.pt',
+    'node2vec-n8': '%s%d-8n_node2vec_embeddings.csv',
+    'node2vec-n16': '%s%d-16n_node2vec_embeddings.csv',
+    'node2vec-n32': '%s%d-32n_node2vec_embeddings.csv',
+    'node2vec-n64': '%s%d_node2vec_embeddings.csv',
+}
+
+kmeans_pattern = 'kmeans_model%s_k%d.joblib'
+
+# packed artifact (see store.py), filled with (domain, k, variant); preferred when present
+store_pattern = '%s%d-%s.topo'
+
+
+def topology_paths(domain, variant, k=40, root='.'):
+    """ Return (kmeans_path, embedding_path) for a domain and embedding variant """
+    
+    if variant not in embedding_variants:
+        raise Exception('topology: unknown embedding variant %s, choose from %s' % (variant, sorted(embedding_variants.keys())))
+    kmeans_path = os.path.join(root, kmeans_pattern % (domain.capitalize(), k))
+    embedding_path = os.path.join(root, embedding_variants[variant] % (domain, k))
+    return kmeans_path, embedding_path
+
+
+class TopologyRegistry:
+    """ Loads each topology artifact once; agents in the same process share the arrays """
+
+    def __init__(self):
+        self.artifacts = {}
+
+    def get(self, domain, variant='graphsage-n32', k=40, root='.'):
+        store_path = os.path.join(root, store_pattern % (domain, k, variant))
+        if os.path.isfile(store_path):
+            key = (os.path.abspath(store_path), )
+            if key not in self.artifacts:
+                self.artifacts[key] = TopologyArtifact.from_store(store_path)
+            return self.artifacts[key]
+        
+        kmeans_path, embedding_path = topology_paths(domain, variant, k, root)
+        key = (os.path.abspath(kmeans_path), os.path.abspath(embedding_path))
+        if key not in self.artifacts:
+            for path in key:
+                if not os.path.isfile(path):
+                    raise Exception('topology: missing artifact %s for domain %s, variant %s' % (path, domain, variant))
+            self.artifacts[key] = TopologyArtifact.from_files(kmeans_path, embedding_path)
+        return self.artifacts[key]
+
+
+topology_registry = TopologyRegistry()
@@ -0,0 +1,115 @@
+"""
+Binary topology artifact format (.topo)
+
+One file holds everything an agent needs about the cluster graph: the k-means
+centroids, the float32 node embedding table and the CSR adjacency of the
+transition graph. Layout:
+
+    b'GSRLTOPO' | uint32 version | uint32 header length | JSON header | arrays
+
+The JSON header records the dtype, shape and byte offset of every array, and
+arrays start on 64-byte boundaries. Loading maps them read-only with
+np.memmap, so nothing is parsed or unpickled and processes opening the same
+file share its pages.
+
+Command: python -m deep_dialog.topology.store --kmeans_path kmeans_modelMovie_k40.joblib --embedding_path movie40graphsage-n32_node_embeddings_adj_recon.pt --graph movie40transition_graph.edgelist --out movie40-graphsage-n32.topo
+"""
+
+import argparse, json, os, struct
+
+import numpy as np
+from joblib import load
+
+from .embedding import load_embedding_table
+from .graph import TransitionGraph
+
+
+MAGIC = b'GSRLTOPO'
+VERSION = 1
+ALIGNMENT = 64
+
+
+def save_topology(path, centroids, embeddings, indptr=None, indices=None, weights=None, meta=None):
+    """ Write a .topo file; centroids stay float64 (exact k-means labels), embeddings are stored as float32 """
+    
+    arrays = [('centroids', np.ascontiguousarray(centroids, dtype=np.float64)),
+              ('embeddings', np.ascontiguousarray(embeddings, dtype=np.float32))]
+    if indptr is not None:
+        arrays += [('indptr', np.ascontiguousarray(indptr, dtype=np.int64)),
+                   ('indices', np.ascontiguousarray(indices, dtype=np.int32)),
+                   ('weights', np.ascontiguousarray(weights, dtype=np.float32))]
+    
+    header = {'meta': meta or {}, 'arrays': {}}
+    offset = 0
+    for name, array in arrays:
+        header['arrays'][name] = {'dtype': array.dtype.str, 'shape': list(array.shape), 'offset': offset}
+        offset += -(-array.nbytes // ALIGNMENT) * ALIGNMENT
+    header_bytes = json.dumps(header).encode('utf-8')
+    data_start = -(-(len(MAGIC) + 8 + len(header_bytes)) // ALIGNMENT) * ALIGNMENT
+    
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(MAGIC)
+        f.write(struct.pack('<II', VERSION, len(header_bytes)))
+        f.write(header_bytes)
+        for name, array in arrays:
+            f.seek(data_start + header['arrays'][name]['offset'])
+            f.write(array.tobytes())
+    os.replace(tmp_path, path)
+
+
+def load_topology(path):
+    """ Memory-map a .topo file: returns (arrays, meta) with read-only arrays """
+    
+    with open(path, 'rb') as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise Exception('%s is not a topology artifact' % (path, ))
+        version, header_length = struct.unpack('<II', f.read(8))
+        if version > VERSION:
+            raise Exception('%s has format version %d, this reader supports up to %d' % (path, version, VERSION))
+        header = json.loads(f.read(header_length).decode('utf-8'))
+    data_start = -(-(len(MAGIC) + 8 + header_length) // ALIGNMENT) * ALIGNMENT
+    
+    arrays = {}
+    for name, spec in list(header['arrays'].items()):
+        shape = tuple(spec['shape'])
+        if int(np.prod(shape)) == 0:
+            arrays[name] = np.zeros(shape, dtype=np.dtype(spec['dtype']))
+        else:
+            arrays[name] = np.memmap(path, dtype=np.dtype(spec['dtype']), mode='r', offset=data_start + spec['offset'], shape=shape)
+    return arrays, header['meta']
+
+
+def convert(kmeans_path, embedding_path, out_path, graph_path=None):
+    """ Pack an existing k-means .joblib, embedding table (.pt/.csv) and transition graph (.edgelist/.npz) into one .topo file """
+    
+    centroids = load(kmeans_path).cluster_centers_
+    embeddings = load_embedding_table(embedding_path)
+    indptr = indices = weights = None
+    if graph_path != None:
+        graph = TransitionGraph.load(graph_path) if graph_path.endswith('.npz') else TransitionGraph.from_edgelist(graph_path)
+        indptr, indices, weights = graph.adjacency()
+    meta = {'kmeans_path': kmeans_path, 'embedding_path': embedding_path, 'graph_path': graph_path}
+    save_topology(out_path, centroids, embeddings, indptr, indices, weights, meta)
+    print(('saved %s: %d clusters x %d features, embeddings %s' % (out_path, centroids.shape[0], centroids.shape[1], embeddings.shape)))
+
+
+def main(params):
+    convert(params['kmeans_path'], params['embedding_path'], params['out'], params['graph'])
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument('--kmeans_path', dest='kmeans_path', type=str, default='kmeans_modelMovie_k40.joblib')
+    parser.add_argument('--embedding_path', dest='embedding_path', type=str, default='movie40graphsage-n32_node_embeddings_adj_recon.pt')
+    parser.add_argument('--graph', dest='graph', type=str, default='movie40transition_graph.edgelist', help='transition graph (.edgelist or .npz snapshot)')
+    parser.add_argument('--out', dest='out', type=str, default='movie40-graphsage-n32.topo')
+
+    args = parser.parse_args()
+    params = vars(args)
+
+    print ("Topology Artifact Parameters:")
+    print((json.dumps(params, indent=2)))
+
+    main(params)
@@ -26,15 +26,17 @@ RL: python run.py --agt 9 --usr 1 --max_turn 40 --kb_path .\deep_dialog\data\mov
 @author: xiul, t-zalipt
 """
 
-import argparse, json, copy, os, csv
+import argparse, json, copy, os, itertools
 import pickle as pickle
 
 import torch
 from collections import deque
 
-from deep_dialog.dialog_system import DialogManager, text_to_dict
-from deep_dialog.agents import AgentCmd, InformAgent, RequestAllAgent, RandomAgent, EchoAgent, RequestBasicsAgent, AgentDQN, RequestInformSlotAgent
+from deep_dialog.dialog_system import DialogManager, VecDialogManager, RolloutWorkers, benchmark, text_to_dict
+from deep_dialog.dialog_system.transition_log import TransitionLogger
+from deep_dialog.agents import AgentCmd, InformAgent, RequestAllAgent, RandomAgent, EchoAgent, RequestBasicsAgent, AgentDQN, RequestInformSlotAgent, LearnerThread
 from deep_dialog.usersims import RuleSimulator, RuleRestaurantSimulator, RuleTaxiSimulator
+from deep_dialog.topology import topology_domains, topology_registry, TransitionGraph
 
 from deep_dialog import dialog_config
 from deep_dialog.dialog_config import *
@@ -119,6 +121,30 @@ if __name__ == "__main__":
     parser.add_argument('--noisy', type=int, default=0)
     parser.add_argument('--distributional', type=int, default=0)
     
+    # topology artifacts (k-means model + GRL embeddings)
+    parser.add_argument('--topology_domain', dest='topology_domain', type=str, default=None, help='movie/restaurant/taxi; default is derived from --agt')
+    parser.add_argument('--topology_variant', dest='topology_variant', type=str, default='graphsage-n32', help='graphsage-n8/n16/n32 or node2vec-n8/n16/n32/n64')
+    parser.add_argument('--topology_k', dest='topology_k', type=int, default=40, help='number of k-means clusters')
+    parser.add_argument('--topology_dir', dest='topology_dir', type=str, default='.', help='directory holding the topology artifacts')
+    parser.add_argument('--transition_graph_path', dest='transition_graph_path', type=str, default=None, help='record the cluster transition graph online and snapshot it to this .npz file')
+    parser.add_argument('--transition_graph_snapshot_every', dest='transition_graph_snapshot_every', type=int, default=10000, help='number of transitions between transition graph snapshots')
+    parser.add_argument('--kmeans_update_every', dest='kmeans_update_every', type=int, default=0, help='streaming k-means step every N training steps; 0 keeps the clusters frozen')
+    parser.add_argument('--kmeans_batch_size', dest='kmeans_batch_size', type=int, default=256, help='number of replayed states per streaming k-means step')
+    parser.add_argument('--finetune_topology', dest='finetune_topology', type=int, default=0, help='1: fine-tune the topology embeddings with the TD error (replay stores cluster ids)')
+    parser.add_argument('--topology_lr', dest='topology_lr', type=float, default=0.001, help='learning rate of the topology embeddings')
+    parser.add_argument('--sparse_state', dest='sparse_state', type=int, default=0, help='1: keep states as dense values + active feature indices, first Q-network layer is an embedding bag')
+    parser.add_argument('--sparse_state_width', dest='sparse_state_width', type=int, default=64, help='maximum number of active binary features of a sparse state')
+    parser.add_argument('--vec_envs', dest='vec_envs', type=int, default=0, help='number of dialogs simulated in lockstep by simulation_epoch and warm start; 0 runs them one at a time')
+    parser.add_argument('--vec_benchmark', dest='vec_benchmark', type=int, default=0, help='only report episodes/sec of N simulated episodes for 1, 2, 4, ... --vec_envs dialogs in lockstep')
+    parser.add_argument('--rollout_workers', dest='rollout_workers', type=int, default=0, help='number of worker processes running simulation_epoch and warm start episodes; 0 runs them in this process')
+    parser.add_argument('--rollout_seed', dest='rollout_seed', type=int, default=0, help='seed of the rollout episodes (each task of episodes gets its own seed)')
+    parser.add_argument('--rollout_episodes_per_task', dest='rollout_episodes_per_task', type=int, default=5, help='number of episodes handed to a rollout worker at once')
+    parser.add_argument('--per_max_priority', dest='per_max_priority', type=int, default=0, help='1: with --per, store new transitions with the max priority and compute their TD errors in batches before training')
+    parser.add_argument('--replay_dir', dest='replay_dir', type=str, default=None, help='keep the uniform replay buffer memory-mapped in this directory; an existing buffer there is resumed and warm start is skipped')
+    parser.add_argument('--transition_log', dest='transition_log', type=str, default=None, help='stream every transition stored in the replay pool to this binary .trlog file')
+    parser.add_argument('--replay_ratio', dest='replay_ratio', type=float, default=0, help='train in a learner thread at this many gradient updates per simulated transition; 0 trains inline after every turn')
+    parser.add_argument('--topology_cache_size', dest='topology_cache_size', type=int, default=50000, help='number of states kept in the state-to-cluster LRU cache; 0 disables it')
+    
     args = parser.parse_args()
     params = vars(args)
 
@@ -182,8 +208,22 @@ agent_params['dueling_dqn'] = params['dueling_dqn']
 agent_params['double_dqn'] = params['double_dqn']
 agent_params['icm'] = params['icm']
 agent_params['per'] = params['per']
+agent_params['per_max_priority'] = params['per_max_priority']
+agent_params['replay_dir'] = params['replay_dir']
 agent_params['noisy'] = params['noisy']
 agent_params['distributional'] = params['distributional']
+agent_params['topology_cache_size'] = params['topology_cache_size']
+agent_params['kmeans_update_every'] = params['kmeans_update_every']
+agent_params['kmeans_batch_size'] = params['kmeans_batch_size']
+agent_params['finetune_topology'] = params['finetune_topology']
+agent_params['topology_lr'] = params['topology_lr']
+agent_params['sparse_state'] = params['sparse_state']
+agent_params['sparse_state_width'] = params['sparse_state_width']
+
+if agt in topology_domains:
+    topology_domain = params['topology_domain'] or topology_domains[agt]
+    agent_params['topology'] = topology_registry.get(topology_domain, params['topology_variant'], params['topology_k'], params['topology_dir'])
+    print(('Topology: %s + %s (loaded in %.2fs)' % (agent_params['topology'].kmeans_path, agent_params['topology'].embedding_path, agent_params['topology'].load_time)))
 
 if agt == 0:
     agent = AgentCmd(kb, act_set, slot_set, agent_params)
@@ -280,7 +320,27 @@ user_sim.set_nlu_model(nlu_model)
 ################################################################################
 # Dialog Manager
 ################################################################################
-dialog_manager = DialogManager(agent, user_sim, act_set, slot_set, kb)
+transition_graph = None
+if params['transition_graph_path'] != None and 'topology' in agent_params:
+    transition_graph = TransitionGraph(agent_params['topology'].n_clusters, len(dialog_config.feasible_actions),
+                                       snapshot_path=params['transition_graph_path'], snapshot_every=params['transition_graph_snapshot_every'])
+dialog_manager = DialogManager(agent, user_sim, act_set, slot_set, kb, transition_graph=transition_graph)
+vec_dialog_manager = None
+if params['vec_envs'] > 0:
+    vec_dialog_manager = VecDialogManager(agent, user_sim, act_set, slot_set, kb, params['vec_envs'], transition_graph)
+transition_logger = None
+if params['transition_log'] is not None and (agt == 9 or agt == 12 or agt == 13):
+    transition_logger = TransitionLogger(params['transition_log'], agent.representation_size, meta={'agt': agt})
+    agent.transition_logger = transition_logger
+
+learner = None
+if params['replay_ratio'] > 0 and (agt == 9 or agt == 12 or agt == 13):
+    learner = LearnerThread(agent, params['batch_size'], params['replay_ratio'])
+rollout_workers = None
+if params['rollout_workers'] > 0:
+    if vec_dialog_manager is not None or transition_graph is not None:
+        raise Exception("--rollout_workers cannot be combined with --vec_envs or --transition_graph_path")
+    rollout_workers = RolloutWorkers(dialog_manager, params['rollout_workers'], params['rollout_seed'], params['rollout_episodes_per_task'])
     
 ################################################################################
 #   Run num_episodes Conversation Simulations
@@ -318,7 +378,7 @@ def save_model(path, agt, success_rate, agent, best_epoch, cur_epoch):
         checkpoint['state_dict'] = {k: v.cpu() for k, v in list(agent.dqn.state_dict().items())}
     if (agt == 12 or agt == 13): checkpoint['model'] = copy.deepcopy(agent.dqn.model)
     checkpoint['params'] = params
-    checkpoint['agent_params'] = agent_params
+    checkpoint['agent_params'] = {k: v for k, v in list(agent_params.items()) if k != 'topology'}
     try:
         torch.save(checkpoint, open(filepath, "wb+"))
         print('saved model in %s' % (filepath, ))
@@ -337,6 +397,11 @@ def save_performance_records(path, agt, records):
         print('Error: Writing model fails: %s' % (filepath, ))
         print(e)
 
+""" Store the transitions of an episode simulated by a rollout worker """
+def store_episode(episode):
+    for transition in episode['transitions']:
+        agent.append_experience(*transition)
+
 """ Run N simulation Dialogues """
 def simulation_epoch(simulation_epoch_size, train=False):
     successes = 0
@@ -347,32 +412,62 @@ def simulation_epoch(simulation_epoch_size, train=False):
     update_count = 0
     step = 0
     
+    n_episodes = simulation_epoch_size
     res = {}
-    for episode in range(simulation_epoch_size):
-        dialog_manager.initialize_episode()
-        episode_over = False
-        while(not episode_over):
-            episode_over, reward = dialog_manager.next_turn()
-            #cumulative_intrinsic_reward += dialog_manager.instrinsic_reward
-            cumulative_reward += reward
-            step += 1
-            if episode_over:
-                if reward > 0: 
-                    successes += 1
-                    #print ("simulation episode %s: Success" % (episode))
-                #else: print ("simulation episode %s: Fail" % (episode))
-                cumulative_turns += dialog_manager.state_tracker.turn_count
-            if train and step % 1 == 0:
+    if vec_dialog_manager is not None or rollout_workers is not None:
+        def train_steps(n_transitions):
+            if learner is not None:
+                learner.observe(n_transitions)
+                return
+            for i in range(n_transitions):
                 err, i_r = agent.train(batch_size, 1)
-                loss += err
-                intrinsic_reward += i_r
-                update_count += 1
+                train_res['loss'] += err
+                train_res['intrinsic_reward'] += i_r
+                train_res['update_count'] += 1
+        def learn(episode):
+            store_episode(episode)
+            if train:
+                train_steps(len(episode['transitions']))
+        train_res = {'loss': 0, 'intrinsic_reward': 0, 'update_count': 0}
+        if vec_dialog_manager is not None:
+            parallel_res = vec_dialog_manager.run(simulation_epoch_size, on_step=train_steps if train else None)
+        else:
+            parallel_res = rollout_workers.run(simulation_epoch_size, learn)
+        successes, cumulative_reward, cumulative_turns = parallel_res['successes'], parallel_res['cumulative_reward'], parallel_res['cumulative_turns']
+        loss, intrinsic_reward, update_count = train_res['loss'], train_res['intrinsic_reward'], train_res['update_count']
+        n_episodes = parallel_res['episodes']
+    else:
+        for episode in range(simulation_epoch_size):
+            dialog_manager.initialize_episode()
+            episode_over = False
+            while(not episode_over):
+                episode_over, reward = dialog_manager.next_turn()
+                #cumulative_intrinsic_reward += dialog_manager.instrinsic_reward
+                cumulative_reward += reward
+                step += 1
+                if episode_over:
+                    if reward > 0: 
+                        successes += 1
+                        #print ("simulation episode %s: Success" % (episode))
+                    #else: print ("simulation episode %s: Fail" % (episode))
+                    cumulative_turns += dialog_manager.state_tracker.turn_count
+                if train and learner is not None:
+                    learner.observe(1)
+                elif train and step % 1 == 0:
+                    err, i_r = agent.train(batch_size, 1)
+                    loss += err
+                    intrinsic_reward += i_r
+                    update_count += 1
+    if train and learner is not None:
+        learner_stats = learner.stats()
+        loss, intrinsic_reward, update_count = learner_stats['loss'], learner_stats['intrinsic_reward'], learner_stats['window_updates']
+        print(("learner: %s updates (%.1f/s), replay ratio %.2f" % (learner_stats['updates'], learner_stats['updates_per_sec'], learner_stats['replay_ratio'])))
     if train:
         print(("cur bellman err %.4f, experience replay pool %s" % (loss/(update_count+1e-10), len(agent.experience_replay_pool))))
-    res['success_rate'] = float(successes)/simulation_epoch_size
-    res['ave_reward'] = float(cumulative_reward)/simulation_epoch_size
-    res['ave_turns'] = float(cumulative_turns)/simulation_epoch_size
-    res['ave_intrinsic_reward'] = float(intrinsic_reward)/simulation_epoch_size
+    res['success_rate'] = float(successes)/n_episodes
+    res['ave_reward'] = float(cumulative_reward)/n_episodes
+    res['ave_turns'] = float(cumulative_turns)/n_episodes
+    res['ave_intrinsic_reward'] = float(intrinsic_reward)/n_episodes
     print(("simulation success rate %s, ave reward %s, ave turns %s, i_r %s" % (res['success_rate'], res['ave_reward'], res['ave_turns'], res['ave_intrinsic_reward'])))
     return res
 
@@ -384,23 +479,33 @@ def warm_start_simulation():
     
     res = {}
     warm_start_run_epochs = 0
-    for episode in range(warm_start_epochs):
-        dialog_manager.initialize_episode()
-        episode_over = False
-        while(not episode_over):
-            episode_over, reward = dialog_manager.next_turn()
-            cumulative_reward += reward
-            if episode_over:
-                if reward > 0: 
-                    successes += 1
-                #    print ("warm_start simulation episode %s: Success" % (episode))
-                #else: print ("warm_start simulation episode %s: Fail" % (episode))
-                cumulative_turns += dialog_manager.state_tracker.turn_count
+    if vec_dialog_manager is not None or rollout_workers is not None:
+        replay_full = lambda: len(agent.experience_replay_pool) >= agent.experience_replay_pool_size
+        if vec_dialog_manager is not None:
+            parallel_res = vec_dialog_manager.run(warm_start_epochs, stop=replay_full)
+        else:
+            parallel_res = rollout_workers.run(warm_start_epochs, store_episode, stop=replay_full)
+        successes, cumulative_reward, cumulative_turns = parallel_res['successes'], parallel_res['cumulative_reward'], parallel_res['cumulative_turns']
+        warm_start_run_epochs = parallel_res['episodes']
+        episode = warm_start_run_epochs - 1
+    else:
+        for episode in range(warm_start_epochs):
+            dialog_manager.initialize_episode()
+            episode_over = False
+            while(not episode_over):
+                episode_over, reward = dialog_manager.next_turn()
+                cumulative_reward += reward
+                if episode_over:
+                    if reward > 0: 
+                        successes += 1
+                    #    print ("warm_start simulation episode %s: Success" % (episode))
+                    #else: print ("warm_start simulation episode %s: Fail" % (episode))
+                    cumulative_turns += dialog_manager.state_tracker.turn_count
         
-        warm_start_run_epochs += 1
+            warm_start_run_epochs += 1
         
-        if len(agent.experience_replay_pool) >= agent.experience_replay_pool_size:
-            break
+            if len(agent.experience_replay_pool) >= agent.experience_replay_pool_size:
+                break
 
     agent.warm_start = 2
     res['success_rate'] = float(successes)/warm_start_run_epochs
@@ -410,107 +515,37 @@ def warm_start_simulation():
     print(("Current experience replay buffer size %s" % (len(agent.experience_replay_pool))))
 
 
-"""def save_replay_pool_to_csv(experience_replay_pool, csv_path, max_turns=100000):
-    # check if file exists
-    file_exists = os.path.isfile(csv_path)
-    
-    # count how many lines already written
-    if file_exists:
-        with open(csv_path, 'r') as f:
-            existing_lines = sum(1 for _ in f)
-    else:
-        existing_lines = 0
-    
-    # calculate how many new can be added
-    remaining_slots = max_turns - existing_lines
-    if remaining_slots <= 0:
-        print("CSV already has 100000 turns. No more data will be added.")
-        return
-    
-    # prepare data to write
-    rows_to_write = []
-    for experience in experience_replay_pool:
-        # assuming each experience is (state, action, reward, next_state, done)
-        state, action, reward, next_state, done = experience
-        rows_to_write.append([state, action, reward, next_state, done])
-    
-    # only add up to remaining slots
-    rows_to_write = rows_to_write[:remaining_slots]
-    
-    # write or append
-    with open(csv_path, 'a', newline='') as f:
-        writer = csv.writer(f)
-        # if new file, write header first
-        if not file_exists:
-            writer.writerow(['state', 'action', 'reward', 'next_state', 'done'])
-        writer.writerows(rows_to_write)
-    
-    print(f"Saved {len(rows_to_write)} new experiences to {csv_path}. Now total {existing_lines + len(rows_to_write)}.")
-
-"""
-
-
-
-def save_replay_pool_to_csv(experience_replay_pool, csv_path, max_turns=100000, batch_size=10000):
-    # Count current rows
-    if os.path.exists(csv_path):
-        with open(csv_path, 'r', encoding='utf-8') as f:
-            current_rows = sum(1 for _ in f)
-    else:
-        current_rows = 0  # no file, no rows
-
-    # Check if CSV is already full
-    if current_rows >= max_turns + 1:  # +1 for header
-        print(f"CSV already has {current_rows} rows. Skipping write.")
-        return
-
-    # Check if buffer has enough samples
+def save_replay_pool_to_log(experience_replay_pool, log_path, max_turns=100000, batch_size=10000):
+    """ Append batch_size transitions of the replay pool to a binary transition log of at most max_turns transitions """
     if len(experience_replay_pool) < batch_size:
         print(f"Buffer has only {len(experience_replay_pool)} entries. Waiting until it reaches {batch_size}.")
         return
 
-    # Calculate how many rows can still be written
-    rows_written = current_rows - 1 if current_rows > 0 else 0
-    rows_remaining = max_turns - rows_written
+    with TransitionLogger(log_path, max_rows=max_turns) as logger:
+        if len(logger) >= max_turns:
+            print(f"{log_path} already has {len(logger)} transitions. Skipping write.")
+            return
+        rows_to_write = min(batch_size, max_turns - len(logger))
+        for exp in itertools.islice(experience_replay_pool, rows_to_write):
+            logger.append(exp)
+        print(f"Wrote {rows_to_write} transitions to {log_path} ({len(logger)} in total).")
 
-    if rows_remaining <= 0:
-        print(f"CSV has reached {max_turns} = {len(experience_replay_pool)} rows.")
-        return
 
-    # Determine if header is needed
-    write_header = current_rows == 0
-
-    # Limit batch to remaining space
-
-
-    rows_to_write = min(batch_size, rows_remaining)
-    buffer_list = list(experience_replay_pool)
-    data_to_write = buffer_list[:rows_to_write]
-    #data_to_write = experience_replay_pool[:rows_to_write]
-
-    # Write to CSV
-    with open(csv_path, mode='a', newline='', encoding='utf-8') as csv_file:
-        writer = csv.writer(csv_file)
-        if write_header:
-            writer.writerow(['state', 'action', 'reward', 'next_state', 'done'])
-        for exp in data_to_write:
-            writer.writerow(exp)
-
-    print(f"Wrote {rows_to_write} rows to {csv_path}.")
-
-
-
-        
 #returns_f = open('returns2.log', 'w+')
 def run_episodes(count, status):
     successes = 0
     cumulative_reward = 0
     cumulative_turns = 0
     
-    if (agt == 9 or agt == 12 or agt == 13) and params['trained_model_path'] == None and warm_start == 1:
+    if (agt == 9 or agt == 12 or agt == 13) and params['trained_model_path'] == None and warm_start == 1 and len(agent.experience_replay_pool) > 0:
+        print(("resuming with %s transitions from %s, no warm_start" % (len(agent.experience_replay_pool), params['replay_dir'])))
+        agent.warm_start = 2
+    elif (agt == 9 or agt == 12 or agt == 13) and params['trained_model_path'] == None and warm_start == 1:
         print ('warm_start starting ...')
         warm_start_simulation()
         print ('warm_start finished, start RL training ...')
+    if learner is not None:
+        learner.start()
     
     for episode in range(count):
         print(("Episode: %s" % (episode)))
@@ -552,7 +587,7 @@ def run_episodes(count, status):
                 if simulation_res['success_rate'] >= success_rate_threshold: # threshold = 0.30
                     #Run below for data collecting
                     """if len(agent.experience_replay_pool)>=10000:
-                        save_replay_pool_to_csv(agent.experience_replay_pool, "replay_data_resoho.csv")"""
+                        save_replay_pool_to_log(agent.experience_replay_pool, "replay_data_resoho.trlog")"""
                     agent.reset_replay()
                     #agent.experience_replay_pool = deque(maxlen=params['experience_replay_pool_size']) 
                     agent.predict_mode = True
@@ -562,7 +597,7 @@ def run_episodes(count, status):
                 
             """if best_res['success_rate'] >= 0.5 and len(agent.experience_replay_pool)>=10000 :
                 #agent.reset_replay()#agent.experience_replay_pool
-                save_replay_pool_to_csv(agent.experience_replay_pool, "replay_data_res.csv")"""
+                save_replay_pool_to_log(agent.experience_replay_pool, "replay_data_res.trlog")"""
 
 
 
@@ -589,9 +624,32 @@ def run_episodes(count, status):
     status['successes'] += successes
     status['count'] += count
     
+    if hasattr(agent, 'topology'):
+        print(("Topology embedding: %s" % (agent.topology.stats(), )))
+        print(("State encoding: %s" % (agent.encoding_stats(), )))
+    if transition_graph is not None:
+        transition_graph.save(params['transition_graph_path'])
+        print(("Transition graph: %s nodes, %s edges, %s transitions saved in %s" % (transition_graph.n_nodes, transition_graph.n_edges, transition_graph.n_transitions, params['transition_graph_path'])))
+    
     if (agt == 9 or agt == 12 or agt == 13)  and params['trained_model_path'] == None:
         save_model(params['write_model_dir'], agt, best_res['success_rate'], best_model['model'], best_res['epoch'], count)
         save_performance_records(params['write_model_dir'], agt, performance_records)
     
     
-run_episodes(num_episodes, status)
+if params['vec_benchmark'] > 0:
+    agent.warm_start = 2
+    n_envs_list = [2 ** i for i in range(max(params['vec_envs'], 1).bit_length())]
+    if params['vec_envs'] > n_envs_list[-1]:
+        n_envs_list.append(params['vec_envs'])
+    benchmark(agent, user_sim, act_set, slot_set, kb, n_envs_list, params['vec_benchmark'])
+else:
+    run_episodes(num_episodes, status)
+if learner is not None and learner.is_alive():
+    learner.stop()
+if rollout_workers is not None:
+    rollout_workers.close()
+if params['replay_dir'] is not None and hasattr(agent, 'experience_replay_pool'):
+    agent.experience_replay_pool.flush()
+if transition_logger is not None:
+    transition_logger.close()
+    print(("%s transitions logged in %s" % (len(transition_logger), params['transition_log'])))
@@ -0,0 +1,58 @@
+import numpy as np
+
+from deep_dialog.agents.disk_replay import DiskReplayBuffer
+
+
+def transition(i, dimension=4):
+    """ Transition i goes from state 100 + i to state 101 + i, like consecutive dialog turns """
+    return (np.full((1, dimension), 100. + i), i, float(i), np.full((1, dimension), 101. + i), False)
+
+
+def check(buffer):
+    """ Every stored transition still has the states it was appended with """
+    for state, action, reward, next_state, done in buffer:
+        assert state[0, 0] == 100. + action and next_state[0, 0] == 101. + action, action
+
+
+def test_reopen_after_flush(tmp_path):
+    buffer = DiskReplayBuffer(str(tmp_path), 5, 4, flush_every=100)
+    for i in range(8):
+        buffer.append(transition(i))
+    buffer.flush()
+
+    reopened = DiskReplayBuffer(str(tmp_path))
+    assert [example[1] for example in reopened] == [3, 4, 5, 6, 7]
+    check(reopened)
+
+
+def test_reopen_after_crash(tmp_path):
+    buffer = DiskReplayBuffer(str(tmp_path), 5, 4, flush_every=4)
+    for i in range(8):
+        buffer.append(transition(i))
+    # the writer stops without flushing transitions 8, 9 and 10
+    for i in range(8, 11):
+        buffer.append(transition(i))
+    del buffer
+
+    reopened = DiskReplayBuffer(str(tmp_path), flush_every=4)
+    check(reopened)
+    for i in range(11, 13):
+        reopened.append(transition(i))
+    check(reopened)
+    assert [example[1] for example in reopened][-2:] == [11, 12]
+
+    reader = DiskReplayBuffer(str(tmp_path), readonly=True)
+    check(reader)
+
+
+def test_reader_while_writing(tmp_path):
+    buffer = DiskReplayBuffer(str(tmp_path), 5, 4, flush_every=4)
+    for i in range(10):
+        buffer.append(transition(i))
+    reader = DiskReplayBuffer(str(tmp_path), readonly=True)
+    for i in range(10, 13):
+        buffer.append(transition(i))
+        check(reader)
+    buffer.flush()
+    reader.refresh()
+    assert [example[1] for example in reader] == [8, 9, 10, 11, 12]